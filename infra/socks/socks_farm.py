@@ -1,13 +1,20 @@
 from __future__ import annotations
 
+from array import array
 import asyncio
+import base64
+from collections import OrderedDict
 import contextlib
+from dataclasses import dataclass
+import hmac
 import json
 import logging
 import os
 from pathlib import Path
-import secrets
-from typing import Any
+import signal
+import socket
+import struct
+from typing import Any, Iterator
 
 
 logging.basicConfig(
@@ -16,6 +23,23 @@ logging.basicConfig(
 )
 logger = logging.getLogger("socks-farm")
 
+METHOD_OK = b"\x05\x02"
+METHOD_REJECT = b"\x05\xff"
+AUTH_OK = b"\x01\x00"
+AUTH_FAIL = b"\x01\x01"
+REPLY_SUCCESS = b"\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00"
+REPLY_HOST_UNREACH = b"\x05\x04\x00\x01\x00\x00\x00\x00\x00\x00"
+REPLY_CONN_REFUSED = b"\x05\x05\x00\x01\x00\x00\x00\x00\x00\x00"
+REPLY_CMD_NOT_SUPPORTED = b"\x05\x07\x00\x01\x00\x00\x00\x00\x00\x00"
+REPLY_ATYP_NOT_SUPPORTED = b"\x05\x08\x00\x01\x00\x00\x00\x00\x00\x00"
+
+REQUEST_HEAD = struct.Struct("!BBBBB")
+PORT_FIELD = struct.Struct("!H")
+
+PASSWORD_BYTES = 9
+PASSWORD_CHARS = 12
+POOL_WRITE_BUFFER = 1 << 20
+
 
 def parse_port_range(value: str) -> tuple[int, int]:
     parts = value.split("-", maxsplit=1)
@@ -28,269 +52,514 @@ def parse_port_range(value: str) -> tuple[int, int]:
     return start, end
 
 
-def build_pool(start: int, end: int) -> list[dict[str, Any]]:
-    pool: list[dict[str, Any]] = []
-    for port in range(start, end + 1):
-        pool.append(
-            {
+@dataclass(frozen=True)
+class ProxyPool:
+    # Parallel per-port columns, indexed by port - ports[0]; the JSON file keeps its list-of-objects shape.
+    ports: array[int]
+    usernames: list[str]
+    passwords: list[str]
+    active: bytearray
+
+    def entries(self) -> Iterator[dict[str, Any]]:
+        for port, username, password, active in zip(self.ports, self.usernames, self.passwords, self.active):
+            yield {
                 "port": port,
-                "username": f"u{port}",
-                "password": secrets.token_urlsafe(8),
-                "active": True,
+                "username": username,
+                "password": password,
+                "active": bool(active),
             }
-        )
-    return pool
 
 
-def is_pool_compatible(data: Any, start: int, end: int) -> bool:
+def build_pool(start: int, end: int) -> ProxyPool:
+    ports = array("H", range(start, end + 1))
+    # All password entropy in one read: 9 random bytes encode to exactly 12 urlsafe chars, no padding.
+    encoded = base64.urlsafe_b64encode(os.urandom(PASSWORD_BYTES * len(ports))).decode("ascii")
+    return ProxyPool(
+        ports=ports,
+        usernames=[f"u{port}" for port in ports],
+        passwords=[
+            encoded[offset : offset + PASSWORD_CHARS]
+            for offset in range(0, len(encoded), PASSWORD_CHARS)
+        ],
+        active=bytearray(b"\x01") * len(ports),
+    )
+
+
+def parse_pool(data: Any, start: int, end: int) -> ProxyPool | None:
     if not isinstance(data, list):
-        return False
-    if len(data) != (end - start + 1):
-        return False
+        return None
+    size = end - start + 1
+    if len(data) != size:
+        return None
 
-    expected_ports = set(range(start, end + 1))
-    seen_ports: set[int] = set()
+    usernames = [""] * size
+    passwords = [""] * size
+    # One byte per port in the range; duplicates leave a hole that the final count catches.
+    seen_ports = bytearray(size)
 
     for item in data:
         if not isinstance(item, dict):
-            return False
+            return None
         port = item.get("port")
         username = item.get("username")
         password = item.get("password")
-        if not isinstance(port, int) or port not in expected_ports:
-            return False
+        if not isinstance(port, int) or not start <= port <= end:
+            return None
         if not isinstance(username, str) or not username:
-            return False
+            return None
         if not isinstance(password, str) or not password:
-            return False
-        seen_ports.add(port)
+            return None
+        index = port - start
+        seen_ports[index] = 1
+        usernames[index] = username
+        passwords[index] = password
+
+    if seen_ports.count(0):
+        return None
+    return ProxyPool(
+        ports=array("H", range(start, end + 1)),
+        usernames=usernames,
+        passwords=passwords,
+        active=bytearray(b"\x01") * size,
+    )
 
-    return seen_ports == expected_ports
 
+def write_pool(path: Path, pool: ProxyPool) -> None:
+    # One entry per line, streamed through a large buffer; the bot reads this file, so swap it in atomically.
+    tmp_path = path.with_name(path.name + ".tmp")
+    with tmp_path.open("w", encoding="utf-8", buffering=POOL_WRITE_BUFFER) as fh:
+        fh.write("[")
+        separator = "\n  "
+        for entry in pool.entries():
+            fh.write(separator)
+            fh.write(json.dumps(entry, ensure_ascii=False))
+            separator = ",\n  "
+        fh.write("\n]\n")
+    os.replace(tmp_path, path)
 
-def load_or_create_pool(path: Path, start: int, end: int) -> list[dict[str, Any]]:
+
+def load_or_create_pool(path: Path, start: int, end: int) -> ProxyPool:
     if path.exists():
-        data = json.loads(path.read_text(encoding="utf-8"))
-        if is_pool_compatible(data, start, end):
-            logger.info("Using existing pool file: %s (%d entries)", path, len(data))
-            return data
+        pool = parse_pool(json.loads(path.read_text(encoding="utf-8")), start, end)
+        if pool is not None:
+            logger.info("Using existing pool file: %s (%d entries)", path, len(pool.ports))
+            return pool
 
     path.parent.mkdir(parents=True, exist_ok=True)
-    data = build_pool(start, end)
-    path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
-    logger.info("Generated new pool file: %s (%d entries)", path, len(data))
-    return data
+    pool = build_pool(start, end)
+    write_pool(path, pool)
+    logger.info("Generated new pool file: %s (%d entries)", path, len(pool.ports))
+    return pool
+
+
+HANDSHAKE_RECV_SIZE = 512
+SPLICE_CHUNK = 65536
+SPLICE_SUPPORTED = hasattr(os, "splice")
+DNS_CACHE_SIZE = 4096
+LISTEN_BACKLOG = 512
+SOCKET_BUFFER_SIZE = 1 << 20
+DNS_CACHE_TTL = 60.0
+
+_client_tasks: set[asyncio.Task[None]] = set()
+_dns_cache: OrderedDict[tuple[str, int], tuple[float, list[Any]]] = OrderedDict()
+
+
+async def wait_fd(loop: asyncio.AbstractEventLoop, fd: int, *, writable: bool) -> None:
+    waiter = loop.create_future()
 
+    def wake() -> None:
+        if not waiter.done():
+            waiter.set_result(None)
 
-async def pipe_stream(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    if writable:
+        loop.add_writer(fd, wake)
+    else:
+        loop.add_reader(fd, wake)
+    try:
+        await waiter
+    finally:
+        if writable:
+            loop.remove_writer(fd)
+        else:
+            loop.remove_reader(fd)
+
+
+async def splice_stream(src: socket.socket, dst: socket.socket) -> None:
+    # Moves bytes socket -> pipe -> socket inside the kernel, never copying them into Python.
+    loop = asyncio.get_running_loop()
+    src_fd = src.fileno()
+    dst_fd = dst.fileno()
+    flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+    pipe_r, pipe_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
     try:
         while True:
-            chunk = await reader.read(65536)
-            if not chunk:
+            try:
+                pending = os.splice(src_fd, pipe_w, SPLICE_CHUNK, flags=flags)
+            except BlockingIOError:
+                await wait_fd(loop, src_fd, writable=False)
+                continue
+            if pending == 0:
                 break
-            writer.write(chunk)
-            await writer.drain()
-    except Exception:
+            while pending:
+                try:
+                    pending -= os.splice(pipe_r, dst_fd, pending, flags=flags)
+                except BlockingIOError:
+                    await wait_fd(loop, dst_fd, writable=True)
+    except OSError:
         pass
     finally:
-        with contextlib.suppress(Exception):
-            writer.close()
-            await writer.wait_closed()
+        os.close(pipe_r)
+        os.close(pipe_w)
+        with contextlib.suppress(OSError):
+            dst.shutdown(socket.SHUT_WR)
 
 
-async def read_exact_or_none(reader: asyncio.StreamReader, size: int) -> bytes | None:
+async def pipe_stream(src: socket.socket, dst: socket.socket) -> None:
+    loop = asyncio.get_running_loop()
+    # One buffer per direction, reused for every chunk instead of allocating bytes per read.
+    buffer = bytearray(SPLICE_CHUNK)
+    view = memoryview(buffer)
     try:
-        return await reader.readexactly(size)
-    except Exception:
-        return None
+        while True:
+            nbytes = await loop.sock_recv_into(src, buffer)
+            if not nbytes:
+                break
+            await loop.sock_sendall(dst, view[:nbytes])
+    except OSError:
+        pass
+    finally:
+        with contextlib.suppress(OSError):
+            dst.shutdown(socket.SHUT_WR)
 
 
-async def handle_client(
-    reader: asyncio.StreamReader,
-    writer: asyncio.StreamWriter,
-    expected_username: str,
-    expected_password: str,
-) -> None:
+class HandshakeReader:
+    # Buffers handshake bytes so each SOCKS5 phase usually costs a single recv.
+    __slots__ = ("_sock", "_buffer", "_pos")
+
+    def __init__(self, sock: socket.socket):
+        self._sock = sock
+        self._buffer = bytearray()
+        self._pos = 0
+
+    async def read(self, size: int) -> bytes | None:
+        loop = asyncio.get_running_loop()
+        try:
+            while len(self._buffer) - self._pos < size:
+                chunk = await loop.sock_recv(self._sock, HANDSHAKE_RECV_SIZE)
+                if not chunk:
+                    return None
+                self._buffer += chunk
+        except OSError:
+            return None
+        start = self._pos
+        self._pos += size
+        return bytes(self._buffer[start : self._pos])
+
+    def leftover(self) -> bytes:
+        return bytes(self._buffer[self._pos :])
+
+
+def tune_socket(sock: socket.socket) -> None:
+    # Kernels may clamp or refuse these (and TCP_NODELAY needs a TCP socket); best effort only.
+    for level, option, value in (
+        (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        (socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE),
+        (socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE),
+    ):
+        with contextlib.suppress(OSError):
+            sock.setsockopt(level, option, value)
+
+
+async def resolve(host: str, port: int) -> list[Any]:
+    loop = asyncio.get_running_loop()
+    key = (host, port)
+    now = loop.time()
+    cached = _dns_cache.get(key)
+    if cached is not None and cached[0] > now:
+        _dns_cache.move_to_end(key)
+        return cached[1]
+
+    infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    _dns_cache[key] = (now + DNS_CACHE_TTL, infos)
+    _dns_cache.move_to_end(key)
+    if len(_dns_cache) > DNS_CACHE_SIZE:
+        _dns_cache.popitem(last=False)
+    return infos
+
+
+async def connect_upstream(family: int, sockaddr: Any) -> socket.socket:
+    loop = asyncio.get_running_loop()
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    tune_socket(sock)
+    try:
+        await loop.sock_connect(sock, sockaddr)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+async def open_upstream(host: str, port: int) -> socket.socket:
+    infos = await resolve(host, port)
+    error: OSError | None = None
+    for family, _sock_type, _proto, _canonname, sockaddr in infos:
+        try:
+            return await connect_upstream(family, sockaddr)
+        except OSError as exc:
+            error = exc
+    # Every cached address failed; resolve again next time instead of serving a stale entry.
+    _dns_cache.pop((host, port), None)
+    raise error or OSError(f"Could not resolve {host}")
+
+
+async def negotiate(
+    client: socket.socket,
+    reader: HandshakeReader,
+    expected_username: bytes,
+    expected_password: bytes,
+) -> socket.socket | None:
+    loop = asyncio.get_running_loop()
+
     # Greeting: VER, NMETHODS, METHODS...
-    greeting = await read_exact_or_none(reader, 2)
+    greeting = await reader.read(2)
     if greeting is None:
-        writer.close()
-        return
+        return None
     ver, nmethods = greeting[0], greeting[1]
     if ver != 5:
-        writer.close()
-        return
+        return None
 
-    methods = await read_exact_or_none(reader, nmethods)
+    methods = await reader.read(nmethods)
     if methods is None:
-        writer.close()
-        return
+        return None
 
     # We only support USERNAME/PASSWORD auth (RFC 1929).
     if 0x02 not in methods:
-        writer.write(b"\x05\xff")
-        await writer.drain()
-        writer.close()
-        return
-    writer.write(b"\x05\x02")
-    await writer.drain()
+        await loop.sock_sendall(client, METHOD_REJECT)
+        return None
+    await loop.sock_sendall(client, METHOD_OK)
 
-    auth_header = await read_exact_or_none(reader, 2)
+    auth_header = await reader.read(2)
     if auth_header is None:
-        writer.close()
-        return
+        return None
     auth_ver, username_len = auth_header[0], auth_header[1]
     if auth_ver != 0x01:
-        writer.write(b"\x01\x01")
-        await writer.drain()
-        writer.close()
-        return
+        await loop.sock_sendall(client, AUTH_FAIL)
+        return None
 
-    username_raw = await read_exact_or_none(reader, username_len)
+    username_raw = await reader.read(username_len)
     if username_raw is None:
-        writer.close()
-        return
+        return None
 
-    password_len_raw = await read_exact_or_none(reader, 1)
+    password_len_raw = await reader.read(1)
     if password_len_raw is None:
-        writer.close()
-        return
+        return None
     password_len = password_len_raw[0]
-    password_raw = await read_exact_or_none(reader, password_len)
+    password_raw = await reader.read(password_len)
     if password_raw is None:
-        writer.close()
-        return
+        return None
 
-    username = username_raw.decode("utf-8", errors="ignore")
-    password = password_raw.decode("utf-8", errors="ignore")
-    if username != expected_username or password != expected_password:
-        writer.write(b"\x01\x01")
-        await writer.drain()
-        writer.close()
-        return
+    # Constant-time compare on the raw bytes; `&` keeps both checks unconditional.
+    username_ok = hmac.compare_digest(username_raw, expected_username)
+    password_ok = hmac.compare_digest(password_raw, expected_password)
+    if not (username_ok & password_ok):
+        await loop.sock_sendall(client, AUTH_FAIL)
+        return None
 
-    writer.write(b"\x01\x00")
-    await writer.drain()
+    await loop.sock_sendall(client, AUTH_OK)
 
-    req_head = await read_exact_or_none(reader, 4)
-    if req_head is None:
-        writer.close()
-        return
+    # VER CMD RSV ATYP plus the first address byte (the length for domains), then the rest in one read.
+    head = await reader.read(5)
+    if head is None:
+        return None
 
-    ver, cmd, _rsv, atyp = req_head
+    ver, cmd, _rsv, atyp, first = REQUEST_HEAD.unpack(head)
     if ver != 5 or cmd != 1:
-        writer.write(b"\x05\x07\x00\x01\x00\x00\x00\x00\x00\x00")
-        await writer.drain()
-        writer.close()
-        return
+        await loop.sock_sendall(client, REPLY_CMD_NOT_SUPPORTED)
+        return None
 
     if atyp == 1:  # IPv4
-        addr = await read_exact_or_none(reader, 4)
-        if addr is None:
-            writer.close()
-            return
-        host = ".".join(str(b) for b in addr)
+        tail_len = 3 + 2
     elif atyp == 3:  # DOMAIN
-        ln = await read_exact_or_none(reader, 1)
-        if ln is None:
-            writer.close()
-            return
-        domain_len = ln[0]
-        domain = await read_exact_or_none(reader, domain_len)
-        if domain is None:
-            writer.close()
-            return
-        try:
-            host = domain.decode("idna")
-        except UnicodeError:
-            writer.write(b"\x05\x04\x00\x01\x00\x00\x00\x00\x00\x00")
-            await writer.drain()
-            writer.close()
-            return
+        tail_len = first + 2
     elif atyp == 4:  # IPv6
-        addr = await read_exact_or_none(reader, 16)
-        if addr is None:
-            writer.close()
-            return
-        groups = [addr[i : i + 2] for i in range(0, 16, 2)]
-        host = ":".join(f"{int.from_bytes(group, 'big'):x}" for group in groups)
+        tail_len = 15 + 2
     else:
-        writer.write(b"\x05\x08\x00\x01\x00\x00\x00\x00\x00\x00")
-        await writer.drain()
-        writer.close()
-        return
+        await loop.sock_sendall(client, REPLY_ATYP_NOT_SUPPORTED)
+        return None
 
-    port_raw = await read_exact_or_none(reader, 2)
-    if port_raw is None:
-        writer.close()
-        return
-    port = int.from_bytes(port_raw, "big")
+    tail = await reader.read(tail_len)
+    if tail is None:
+        return None
+    frame = head + tail
+    (port,) = PORT_FIELD.unpack_from(frame, len(frame) - 2)
 
     try:
-        target_reader, target_writer = await asyncio.open_connection(host, port)
+        # Address literals are already a sockaddr; only domains go through the resolver.
+        if atyp == 1:
+            target = await connect_upstream(socket.AF_INET, (socket.inet_ntop(socket.AF_INET, frame[4:8]), port))
+        elif atyp == 4:
+            target = await connect_upstream(socket.AF_INET6, (socket.inet_ntop(socket.AF_INET6, frame[4:20]), port))
+        else:
+            target = await open_upstream(frame[5:-2].decode("idna"), port)
+    except ConnectionRefusedError:
+        await loop.sock_sendall(client, REPLY_CONN_REFUSED)
+        return None
+    except (OSError, UnicodeError):
+        # The idna codec, in our decode and again inside getaddrinfo, raises UnicodeError (e.g. labels over 63 bytes).
+        await loop.sock_sendall(client, REPLY_HOST_UNREACH)
+        return None
+
+    return target
+
+
+async def handle_client(
+    client: socket.socket,
+    expected_username: bytes,
+    expected_password: bytes,
+) -> None:
+    loop = asyncio.get_running_loop()
+    try:
+        reader = HandshakeReader(client)
+        target = await negotiate(client, reader, expected_username, expected_password)
+        if target is None:
+            return
+        with target:
+            await loop.sock_sendall(client, REPLY_SUCCESS)
+            early_data = reader.leftover()
+            if early_data:
+                await loop.sock_sendall(target, early_data)
+            relay = splice_stream if SPLICE_SUPPORTED else pipe_stream
+            # Upload runs as a task, download inline. Each direction half-closes its peer on EOF,
+            # so a finished upload must not cancel a response that is still streaming back.
+            upload = loop.create_task(relay(client, target))
+            try:
+                await relay(target, client)
+                await upload
+            finally:
+                if not upload.done():
+                    upload.cancel()
+                    with contextlib.suppress(asyncio.CancelledError):
+                        await upload
+    except OSError:
+        pass
     except Exception:
-        writer.write(b"\x05\x05\x00\x01\x00\x00\x00\x00\x00\x00")
-        await writer.drain()
-        writer.close()
-        return
+        logger.exception("SOCKS client session failed")
+    finally:
+        client.close()
 
-    writer.write(b"\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00")
-    await writer.drain()
 
-    await asyncio.gather(
-        pipe_stream(reader, target_writer),
-        pipe_stream(target_reader, writer),
-    )
+ACCEPT_RETRY_DELAY = 1.0
+
 
+def accept_clients(
+    listener: socket.socket,
+    port: int,
+    creds_by_port: dict[int, tuple[bytes, bytes]],
+) -> None:
+    # Shared reader callback for every listening port: drains the accept queue, no per-port task.
+    loop = asyncio.get_running_loop()
+    username, password = creds_by_port[port]
+    while True:
+        try:
+            client, _ = listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as exc:
+            logger.warning("Accept failed on port %s: %s", port, exc)
+            fd = listener.fileno()
+            loop.remove_reader(fd)
+            loop.call_later(
+                ACCEPT_RETRY_DELAY,
+                loop.add_reader,
+                fd,
+                accept_clients,
+                listener,
+                port,
+                creds_by_port,
+            )
+            return
+        client.setblocking(False)
+        tune_socket(client)
+        task = loop.create_task(handle_client(client, username, password))
+        _client_tasks.add(task)
+        task.add_done_callback(_client_tasks.discard)
 
-async def start_proxy_server(
+
+def start_proxy_server(
     bind_host: str,
-    item: dict[str, Any],
-) -> tuple[asyncio.base_events.Server | None, Exception | None]:
-    port = int(item["port"])
-    username = str(item["username"])
-    password = str(item["password"])
+    port: int,
+    reuse_port: bool = False,
+) -> tuple[socket.socket | None, Exception | None]:
+    family = socket.AF_INET6 if ":" in bind_host else socket.AF_INET
     try:
-        server = await asyncio.start_server(
-            lambda r, w, u=username, p=password: handle_client(r, w, u, p),
-            host=bind_host,
-            port=port,
-            start_serving=True,
+        listener = socket.create_server(
+            (bind_host, port),
+            family=family,
+            backlog=LISTEN_BACKLOG,
+            # Only forked workers share a port; a lone process must still see a port held by anyone else as busy.
+            reuse_port=reuse_port,
         )
-        return server, None
+        listener.setblocking(False)
+        return listener, None
     except Exception as exc:
         return None, exc
 
 
-async def main() -> None:
+def farm_settings() -> tuple[str, str, Path]:
     bind_host = os.getenv("SOCKS_BIND_HOST", "0.0.0.0").strip() or "0.0.0.0"
     port_range = os.getenv("SOCKS_PORT_RANGE", "30000-30199").strip() or "30000-30199"
     pool_file = Path(os.getenv("SOCKS_POOL_FILE", "/data/proxy_pool.json").strip() or "/data/proxy_pool.json")
+    return bind_host, port_range, pool_file
 
-    start_port, end_port = parse_port_range(port_range)
-    pool = load_or_create_pool(pool_file, start_port, end_port)
 
-    servers: list[asyncio.base_events.Server] = []
-    start_results = await asyncio.gather(*(start_proxy_server(bind_host, item) for item in pool))
+def worker_count() -> int:
+    raw = os.getenv("SOCKS_WORKERS", "").strip()
+    workers = int(raw) if raw else os.cpu_count() or 1
+    # Extra workers only make sense when the kernel can spread one port's accepts across processes.
+    if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+        return 1
+    return max(workers, 1)
+
+
+def pin_worker(worker_id: int) -> None:
+    if not hasattr(os, "sched_setaffinity"):
+        return
+    cpus = sorted(os.sched_getaffinity(0))
+    with contextlib.suppress(OSError):
+        os.sched_setaffinity(0, {cpus[worker_id % len(cpus)]})
+
+
+async def main(pool: ProxyPool | None = None, worker_id: int = 0, reuse_port: bool = False) -> None:
+    bind_host, port_range, pool_file = farm_settings()
+    if pool is None:
+        start_port, end_port = parse_port_range(port_range)
+        pool = load_or_create_pool(pool_file, start_port, end_port)
+
+    loop = asyncio.get_running_loop()
+    creds_by_port: dict[int, tuple[bytes, bytes]] = {}
 
     active_count = 0
     skipped_count = 0
-    for item, (server, error) in zip(pool, start_results):
-        port = int(item["port"])
-        if server is not None:
-            item["active"] = True
-            servers.append(server)
+    for index, (port, username, password) in enumerate(zip(pool.ports, pool.usernames, pool.passwords)):
+        listener, error = start_proxy_server(bind_host, port, reuse_port)
+        if listener is not None:
+            pool.active[index] = 1
+            creds_by_port[port] = (username.encode("utf-8"), password.encode("utf-8"))
+            loop.add_reader(listener.fileno(), accept_clients, listener, port, creds_by_port)
             active_count += 1
             continue
 
-        item["active"] = False
+        pool.active[index] = 0
         skipped_count += 1
         logger.warning("Skipping busy/unavailable port %s: %s", port, error)
 
-    pool_file.write_text(json.dumps(pool, ensure_ascii=False, indent=2), encoding="utf-8")
+    if worker_id == 0:
+        write_pool(pool_file, pool)
 
     logger.info(
-        "SOCKS farm started on %s, range %s (active=%d, skipped=%d)",
+        "SOCKS farm worker %d started on %s, range %s (active=%d, skipped=%d)",
+        worker_id,
         bind_host,
         port_range,
         active_count,
@@ -303,5 +572,45 @@ async def main() -> None:
     await asyncio.Event().wait()
 
 
+def run() -> None:
+    workers = worker_count()
+    if workers == 1:
+        asyncio.run(main())
+        return
+
+    # The pool is generated once before forking so every worker serves the same credentials.
+    _bind_host, port_range, pool_file = farm_settings()
+    start_port, end_port = parse_port_range(port_range)
+    pool = load_or_create_pool(pool_file, start_port, end_port)
+
+    children: set[int] = set()
+    for worker_id in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                pin_worker(worker_id)
+                asyncio.run(main(pool, worker_id, reuse_port=True))
+            except BaseException:
+                logger.exception("SOCKS farm worker %d crashed", worker_id)
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        children.add(pid)
+
+    logger.info("SOCKS farm forked %d workers", workers)
+
+    # Workers never return on their own; if one dies, stop the rest and let the supervisor restart us.
+    pid, status = os.wait()
+    children.discard(pid)
+    logger.error("SOCKS farm worker pid %d exited with status %d", pid, os.waitstatus_to_exitcode(status))
+    for child in children:
+        with contextlib.suppress(ProcessLookupError):
+            os.kill(child, signal.SIGTERM)
+    for child in children:
+        os.waitpid(child, 0)
+    raise SystemExit(1)
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    run()
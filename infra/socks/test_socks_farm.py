@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import asyncio
+import socket
+import struct
+import unittest
+
+import socks_farm
+
+
+class NegotiateDomainTest(unittest.IsolatedAsyncioTestCase):
+    async def request_domain(self, host: bytes) -> bytes:
+        loop = asyncio.get_running_loop()
+        server, client = socket.socketpair()
+        server.setblocking(False)
+        client.setblocking(False)
+        with server, client:
+            await loop.sock_sendall(
+                client,
+                b"\x05\x01\x02"
+                + b"\x01\x04user\x04pass"
+                + b"\x05\x01\x00\x03"
+                + bytes([len(host)])
+                + host
+                + struct.pack("!H", 80),
+            )
+            target = await socks_farm.negotiate(
+                server,
+                socks_farm.HandshakeReader(server),
+                b"user",
+                b"pass",
+            )
+            self.assertIsNone(target)
+            replies = socks_farm.METHOD_OK + socks_farm.AUTH_OK
+            data = b""
+            while len(data) < len(replies) + len(socks_farm.REPLY_HOST_UNREACH):
+                chunk = await loop.sock_recv(client, 64)
+                if not chunk:
+                    break
+                data += chunk
+            return data[len(replies) :]
+
+    async def test_overlong_label_gets_host_unreachable(self) -> None:
+        reply = await self.request_domain(b"a" * 64 + b".com")
+        self.assertEqual(reply, socks_farm.REPLY_HOST_UNREACH)
+
+    async def test_invalid_idna_gets_host_unreachable(self) -> None:
+        reply = await self.request_domain(b"xn--\x80.com")
+        self.assertEqual(reply, socks_farm.REPLY_HOST_UNREACH)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -41,6 +41,9 @@ async def run() -> None:
     db = create_database(
         database_url=settings.database_url,
         database_path=settings.database_path,
+        pool_min_size=settings.database_pool_min_size,
+        pool_max_size=settings.database_pool_max_size,
+        async_expiry_commit=settings.database_async_expiry_commit,
     )
     await db.connect()
     await db.init_schema()
@@ -11,6 +11,9 @@ class Settings:
     bot_token: str
     database_url: str
     database_path: str
+    database_pool_min_size: int
+    database_pool_max_size: int
+    database_async_expiry_commit: bool
     admin_tg_ids: tuple[int, ...]
     proxy_public_host: str
     proxy_pool_file: str
@@ -24,6 +27,13 @@ def _int_env(name: str, default: int) -> int:
     return int(raw)
 
 
+def _bool_env(name: str, default: bool) -> bool:
+    raw = os.getenv(name, "").strip().lower()
+    if not raw:
+        return default
+    return raw in {"1", "true", "yes", "on"}
+
+
 def _int_tuple_env(name: str) -> tuple[int, ...]:
     raw = os.getenv(name, "").strip()
     if not raw:
@@ -48,6 +58,9 @@ def load_settings() -> Settings:
         bot_token=bot_token,
         database_url=os.getenv("DATABASE_URL", "").strip(),
         database_path=os.getenv("DATABASE_PATH", "bot.db").strip() or "bot.db",
+        database_pool_min_size=_int_env("DATABASE_POOL_MIN_SIZE", 4),
+        database_pool_max_size=_int_env("DATABASE_POOL_MAX_SIZE", 32),
+        database_async_expiry_commit=_bool_env("DATABASE_ASYNC_EXPIRY_COMMIT", False),
         admin_tg_ids=_int_tuple_env("ADMIN_TG_IDS"),
         proxy_public_host=os.getenv("PROXY_PUBLIC_HOST", "127.0.0.1").strip() or "127.0.0.1",
         proxy_pool_file=os.getenv("PROXY_POOL_FILE", "data/proxy_pool.json").strip() or "data/proxy_pool.json",
@@ -1,10 +1,14 @@
 from __future__ import annotations
 
+import asyncio
+import base64
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
+import json
 from pathlib import Path
 import secrets
 import time
-from typing import Any
+from typing import Any, AsyncIterator
 from urllib.parse import quote
 
 import aiosqlite
@@ -33,14 +37,71 @@ DEFAULT_PLANS = (
 )
 
 
+LINK_TOKEN_BYTES = 18
+WAL_CHECKPOINT_INTERVAL_SECONDS = 3600
+BAN_CACHE_TTL_SECONDS = 60
+BAN_CACHE_MAX_SIZE = 10_000
+USER_CACHE_TTL_SECONDS = 300
+USER_CACHE_MAX_SIZE = 50_000
+
+
 def now_ts() -> int:
     return int(time.time())
 
 
+def new_link_tokens(count: int) -> list[str]:
+    # One urandom read for the whole batch; 18 bytes encode to exactly 24 urlsafe chars, so no padding to strip.
+    encoded = base64.urlsafe_b64encode(secrets.token_bytes(LINK_TOKEN_BYTES * count)).decode("ascii")
+    size = LINK_TOKEN_BYTES // 3 * 4
+    return [encoded[offset : offset + size] for offset in range(0, len(encoded), size)]
+
+
+class Transaction:
+    # Outermost scope owns BEGIN/COMMIT; nested scopes map to savepoints so they can roll back alone.
+    def __init__(self, conn: Any, savepoint: str | None):
+        self._conn = conn
+        self._savepoint = savepoint
+        self.finished = False
+
+    async def commit(self) -> None:
+        if self.finished:
+            return
+        self.finished = True
+        if self._savepoint is None:
+            await self._conn.commit()
+        else:
+            await self._conn.execute(f"RELEASE SAVEPOINT {self._savepoint}")
+
+    async def rollback(self) -> None:
+        if self.finished:
+            return
+        self.finished = True
+        if self._savepoint is None:
+            await self._conn.rollback()
+        else:
+            await self._conn.execute(f"ROLLBACK TO SAVEPOINT {self._savepoint}")
+            await self._conn.execute(f"RELEASE SAVEPOINT {self._savepoint}")
+
+
 class Database:
-    def __init__(self, path: str):
+    def __init__(self, path: str, read_pool_size: int = 2):
         self.path = path
+        self.read_pool_size = read_pool_size
         self._conn: aiosqlite.Connection | None = None
+        self._readers: list[aiosqlite.Connection] = []
+        self._idle_readers: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        self._plan_cache: dict[str, Plan] | None = None
+        # Every update checks the ban list; entries expire on their own and are dropped on ban/unban.
+        self._ban_cache: dict[int, tuple[float, dict[str, Any] | None]] = {}
+        # tg_user_id -> (expires at, users.id, profile fields last written); only committed upserts land here.
+        self._user_cache: dict[int, tuple[float, int, tuple[str | None, str | None, str | None]]] = {}
+        # One writer connection: a task holds the lock for its whole write scope, others queue behind it.
+        self._write_lock = asyncio.Lock()
+        # Ownership is the task itself: a ContextVar would be copied into tasks spawned inside the scope.
+        self._write_owner: asyncio.Task[Any] | None = None
+        # transaction() nesting of the lock owner; only the owner ever reads or changes it.
+        self._tx_depth = 0
+        self._last_checkpoint_at = time.monotonic()
 
     @property
     def conn(self) -> aiosqlite.Connection:
@@ -50,131 +111,261 @@ class Database:
 
     async def connect(self) -> None:
         Path(self.path).parent.mkdir(parents=True, exist_ok=True)
-        self._conn = await aiosqlite.connect(self.path)
+        # Autocommit: a lone write statement commits itself in its single thread hop, explicit scopes come from transaction().
+        self._conn = await aiosqlite.connect(self.path, isolation_level=None)
         self._conn.row_factory = aiosqlite.Row
         await self._conn.execute("PRAGMA foreign_keys = ON;")
-        await self._conn.commit()
+        await self._conn.execute("PRAGMA journal_mode = WAL;")
+        await self._conn.execute("PRAGMA synchronous = NORMAL;")
+        await self._conn.execute("PRAGMA temp_store = MEMORY;")
+        await self._conn.execute("PRAGMA cache_size = -64000;")
+        await self._conn.execute("PRAGMA mmap_size = 30000000000;")
+        await self._conn.execute("PRAGMA busy_timeout = 5000;")
+
+        # WAL lets these read alongside the single writer; an in-memory database is private to one connection.
+        if self.path != ":memory:":
+            for _ in range(self.read_pool_size):
+                reader = await aiosqlite.connect(self.path)
+                reader.row_factory = aiosqlite.Row
+                await reader.execute("PRAGMA query_only = ON;")
+                await reader.execute("PRAGMA temp_store = MEMORY;")
+                await reader.execute("PRAGMA cache_size = -16000;")
+                await reader.execute("PRAGMA mmap_size = 30000000000;")
+                await reader.execute("PRAGMA busy_timeout = 5000;")
+                self._readers.append(reader)
+                self._idle_readers.put_nowait(reader)
 
     async def close(self) -> None:
+        for reader in self._readers:
+            await reader.close()
+        self._readers.clear()
+        self._idle_readers = asyncio.Queue()
         if self._conn is not None:
-            await self._conn.close()
-            self._conn = None
+            async with self._writing():
+                # Persists fresh planner statistics for whatever this process queried.
+                await self._conn.execute("PRAGMA optimize;")
+                await self._conn.close()
+                self._conn = None
+
+    def _owns_write_lock(self) -> bool:
+        return self._write_owner is not None and self._write_owner is asyncio.current_task()
+
+    @asynccontextmanager
+    async def _writing(self) -> AsyncIterator[None]:
+        if self._owns_write_lock():
+            yield
+            return
+        async with self._write_lock:
+            self._write_owner = asyncio.current_task()
+            try:
+                yield
+            finally:
+                self._write_owner = None
+
+    async def _read(self, sql: str, params: tuple[Any, ...] = ()) -> list[aiosqlite.Row]:
+        # The lock holder reads on the writer to see its own changes; without readers everyone else waits for it.
+        if self._owns_write_lock():
+            return await self.conn.execute_fetchall(sql, params)
+        if not self._readers:
+            async with self._writing():
+                return await self.conn.execute_fetchall(sql, params)
+
+        reader = await self._idle_readers.get()
+        try:
+            return await reader.execute_fetchall(sql, params)
+        finally:
+            self._idle_readers.put_nowait(reader)
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[Transaction]:
+        """Hold the single writer for this task until the scope ends.
+
+        Do not spawn tasks (create_task, gather) that touch the database inside the scope:
+        they are not the owner, so they wait for the lock and deadlock an owner that awaits them.
+        """
+        async with self._writing():
+            depth = self._tx_depth
+            if depth == 0:
+                await self.conn.execute("BEGIN IMMEDIATE")
+                tx = Transaction(self.conn, None)
+            else:
+                savepoint = f"sp_{depth}"
+                await self.conn.execute(f"SAVEPOINT {savepoint}")
+                tx = Transaction(self.conn, savepoint)
+            self._tx_depth = depth + 1
+            try:
+                yield tx
+            except BaseException:
+                await tx.rollback()
+                raise
+            else:
+                await tx.commit()
+            finally:
+                self._tx_depth = depth
+
+    async def _commit(self) -> None:
+        # Inside transaction() the enclosing scope decides when to commit; in autocommit there is usually nothing open.
+        if self._tx_depth == 0 and self.conn.in_transaction:
+            await self.conn.commit()
 
     async def init_schema(self) -> None:
-        await self.conn.executescript(
-            """
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                tg_user_id INTEGER NOT NULL UNIQUE,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                created_at INTEGER NOT NULL,
-                updated_at INTEGER NOT NULL
-            );
-
-            CREATE TABLE IF NOT EXISTS plans (
-                code TEXT PRIMARY KEY,
-                title TEXT NOT NULL,
-                devices_count INTEGER NOT NULL,
-                price_rub INTEGER NOT NULL,
-                duration_days INTEGER NOT NULL
-            );
-
-            CREATE TABLE IF NOT EXISTS payments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL REFERENCES users(id),
-                plan_code TEXT NOT NULL REFERENCES plans(code),
-                amount_rub INTEGER NOT NULL,
-                status TEXT NOT NULL CHECK(status IN ('pending', 'paid', 'cancelled')),
-                created_at INTEGER NOT NULL,
-                paid_at INTEGER
-            );
-
-            CREATE TABLE IF NOT EXISTS subscriptions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL REFERENCES users(id),
-                plan_code TEXT NOT NULL REFERENCES plans(code),
-                payment_id INTEGER NOT NULL UNIQUE REFERENCES payments(id),
-                status TEXT NOT NULL CHECK(status IN ('active', 'expired')),
-                created_at INTEGER NOT NULL,
-                expires_at INTEGER NOT NULL,
-                notified_expired INTEGER NOT NULL DEFAULT 0
-            );
-
-            CREATE TABLE IF NOT EXISTS proxy_links (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                subscription_id INTEGER NOT NULL REFERENCES subscriptions(id),
-                user_id INTEGER NOT NULL REFERENCES users(id),
-                device_number INTEGER NOT NULL,
-                token TEXT NOT NULL UNIQUE,
-                link TEXT NOT NULL,
-                status TEXT NOT NULL CHECK(status IN ('active', 'expired')),
-                created_at INTEGER NOT NULL,
-                expires_at INTEGER NOT NULL
-            );
-
-            CREATE TABLE IF NOT EXISTS proxy_pool (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                port INTEGER NOT NULL UNIQUE,
-                username TEXT NOT NULL,
-                password TEXT NOT NULL,
-                status TEXT NOT NULL CHECK(status IN ('free', 'assigned')),
-                assigned_link_id INTEGER UNIQUE REFERENCES proxy_links(id),
-                created_at INTEGER NOT NULL,
-                updated_at INTEGER NOT NULL
-            );
-
-            CREATE TABLE IF NOT EXISTS proxy_delivery_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                proxy_link_id INTEGER NOT NULL REFERENCES proxy_links(id),
-                user_id INTEGER NOT NULL REFERENCES users(id),
-                tg_user_id INTEGER NOT NULL,
-                user_label TEXT NOT NULL,
-                subscription_id INTEGER REFERENCES subscriptions(id),
-                device_number INTEGER,
-                delivery_source TEXT NOT NULL CHECK(delivery_source IN ('purchase', 'my_links')),
-                proxy_url TEXT NOT NULL,
-                delivered_at INTEGER NOT NULL
-            );
-
-            CREATE TABLE IF NOT EXISTS user_temp_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL REFERENCES users(id),
-                tg_user_id INTEGER NOT NULL,
-                message_id INTEGER NOT NULL,
-                kind TEXT NOT NULL,
-                created_at INTEGER NOT NULL,
-                UNIQUE(user_id, message_id, kind)
-            );
-
-            CREATE TABLE IF NOT EXISTS banned_users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                tg_user_id INTEGER NOT NULL UNIQUE,
-                reason TEXT NOT NULL,
-                blocked_by INTEGER,
-                blocked_at INTEGER NOT NULL
-            );
-
-            CREATE INDEX IF NOT EXISTS idx_users_tg_user_id ON users(tg_user_id);
-            CREATE INDEX IF NOT EXISTS idx_payments_user_status ON payments(user_id, status);
-            CREATE INDEX IF NOT EXISTS idx_subscriptions_user_status ON subscriptions(user_id, status);
-            CREATE INDEX IF NOT EXISTS idx_subscriptions_expires_at ON subscriptions(expires_at);
-            CREATE INDEX IF NOT EXISTS idx_proxy_links_user_status ON proxy_links(user_id, status);
-            CREATE INDEX IF NOT EXISTS idx_proxy_links_expires_at ON proxy_links(expires_at);
-            CREATE INDEX IF NOT EXISTS idx_proxy_pool_status ON proxy_pool(status);
-            CREATE INDEX IF NOT EXISTS idx_proxy_delivery_logs_tg_user_id ON proxy_delivery_logs(tg_user_id);
-            CREATE INDEX IF NOT EXISTS idx_proxy_delivery_logs_proxy_link_id ON proxy_delivery_logs(proxy_link_id);
-            CREATE INDEX IF NOT EXISTS idx_user_temp_messages_user_kind ON user_temp_messages(user_id, kind);
-            CREATE INDEX IF NOT EXISTS idx_banned_users_tg_user_id ON banned_users(tg_user_id);
-            """
-        )
-        await self.seed_plans()
-        await self.conn.commit()
+        async with self._writing():
+            await self.conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    tg_user_id INTEGER NOT NULL UNIQUE,
+                    username TEXT,
+                    first_name TEXT,
+                    last_name TEXT,
+                    created_at INTEGER NOT NULL,
+                    updated_at INTEGER NOT NULL
+                );
+
+                CREATE TABLE IF NOT EXISTS plans (
+                    code TEXT PRIMARY KEY,
+                    title TEXT NOT NULL,
+                    devices_count INTEGER NOT NULL,
+                    price_rub INTEGER NOT NULL,
+                    duration_days INTEGER NOT NULL
+                );
+
+                CREATE TABLE IF NOT EXISTS payments (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL REFERENCES users(id),
+                    plan_code TEXT NOT NULL REFERENCES plans(code),
+                    amount_rub INTEGER NOT NULL,
+                    status TEXT NOT NULL CHECK(status IN ('pending', 'paid', 'cancelled')),
+                    created_at INTEGER NOT NULL,
+                    paid_at INTEGER
+                );
+
+                CREATE TABLE IF NOT EXISTS subscriptions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL REFERENCES users(id),
+                    plan_code TEXT NOT NULL REFERENCES plans(code),
+                    payment_id INTEGER NOT NULL UNIQUE REFERENCES payments(id),
+                    status TEXT NOT NULL CHECK(status IN ('active', 'expired')),
+                    created_at INTEGER NOT NULL,
+                    expires_at INTEGER NOT NULL,
+                    notified_expired INTEGER NOT NULL DEFAULT 0
+                );
+
+                CREATE TABLE IF NOT EXISTS proxy_links (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    subscription_id INTEGER NOT NULL REFERENCES subscriptions(id),
+                    user_id INTEGER NOT NULL REFERENCES users(id),
+                    device_number INTEGER NOT NULL,
+                    token TEXT NOT NULL UNIQUE,
+                    link TEXT NOT NULL,
+                    status TEXT NOT NULL CHECK(status IN ('active', 'expired')),
+                    created_at INTEGER NOT NULL,
+                    expires_at INTEGER NOT NULL
+                );
+
+                CREATE TABLE IF NOT EXISTS proxy_pool (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    port INTEGER NOT NULL UNIQUE,
+                    username TEXT NOT NULL,
+                    password TEXT NOT NULL,
+                    username_enc TEXT NOT NULL DEFAULT '',
+                    password_enc TEXT NOT NULL DEFAULT '',
+                    status TEXT NOT NULL CHECK(status IN ('free', 'assigned')),
+                    assigned_link_id INTEGER UNIQUE REFERENCES proxy_links(id),
+                    created_at INTEGER NOT NULL,
+                    updated_at INTEGER NOT NULL
+                );
+
+                CREATE TABLE IF NOT EXISTS proxy_delivery_logs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    proxy_link_id INTEGER NOT NULL REFERENCES proxy_links(id),
+                    user_id INTEGER NOT NULL REFERENCES users(id),
+                    tg_user_id INTEGER NOT NULL,
+                    user_label TEXT NOT NULL,
+                    subscription_id INTEGER REFERENCES subscriptions(id),
+                    device_number INTEGER,
+                    delivery_source TEXT NOT NULL CHECK(delivery_source IN ('purchase', 'my_links')),
+                    proxy_url TEXT NOT NULL,
+                    delivered_at INTEGER NOT NULL
+                );
+
+                CREATE TABLE IF NOT EXISTS user_temp_messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL REFERENCES users(id),
+                    tg_user_id INTEGER NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    created_at INTEGER NOT NULL,
+                    UNIQUE(user_id, message_id, kind)
+                );
+
+                CREATE TABLE IF NOT EXISTS banned_users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    tg_user_id INTEGER NOT NULL UNIQUE,
+                    reason TEXT NOT NULL,
+                    blocked_by INTEGER,
+                    blocked_at INTEGER NOT NULL
+                );
+
+                DROP INDEX IF EXISTS idx_users_tg_user_id;
+                CREATE INDEX IF NOT EXISTS idx_users_created_at_id ON users(created_at, id);
+                CREATE INDEX IF NOT EXISTS idx_payments_user_status ON payments(user_id, status);
+                DROP INDEX IF EXISTS idx_subscriptions_user_status;
+                DROP INDEX IF EXISTS idx_subscriptions_user_status_expires_at;
+                DROP INDEX IF EXISTS idx_subscriptions_expires_at;
+                CREATE INDEX IF NOT EXISTS idx_subscriptions_active_user
+                    ON subscriptions(user_id, expires_at, plan_code, status) WHERE status = 'active';
+                CREATE INDEX IF NOT EXISTS idx_subscriptions_active_expires_at
+                    ON subscriptions(expires_at) WHERE status = 'active';
+                CREATE INDEX IF NOT EXISTS idx_subscriptions_expired_notified
+                    ON subscriptions(notified_expired) WHERE status = 'expired';
+                DROP INDEX IF EXISTS idx_proxy_links_user_status;
+                DROP INDEX IF EXISTS idx_proxy_links_user_status_expires_at;
+                DROP INDEX IF EXISTS idx_proxy_links_expires_at;
+                CREATE INDEX IF NOT EXISTS idx_proxy_links_user_id ON proxy_links(user_id);
+                CREATE INDEX IF NOT EXISTS idx_proxy_links_active_user
+                    ON proxy_links(user_id, expires_at, subscription_id, device_number, link, status) WHERE status = 'active';
+                CREATE INDEX IF NOT EXISTS idx_proxy_links_active_subscription
+                    ON proxy_links(subscription_id, expires_at) WHERE status = 'active';
+                CREATE INDEX IF NOT EXISTS idx_proxy_links_active_expires_at
+                    ON proxy_links(expires_at) WHERE status = 'active';
+                DROP INDEX IF EXISTS idx_proxy_pool_status;
+                CREATE INDEX IF NOT EXISTS idx_proxy_pool_free ON proxy_pool(port) WHERE status = 'free';
+                CREATE INDEX IF NOT EXISTS idx_proxy_delivery_logs_tg_user_id ON proxy_delivery_logs(tg_user_id);
+                CREATE INDEX IF NOT EXISTS idx_proxy_delivery_logs_proxy_link_id ON proxy_delivery_logs(proxy_link_id);
+                CREATE INDEX IF NOT EXISTS idx_user_temp_messages_user_kind ON user_temp_messages(user_id, kind);
+                DROP INDEX IF EXISTS idx_banned_users_tg_user_id;
+                """
+            )
+            await self._add_missing_columns(
+                "proxy_pool",
+                {
+                    "username_enc": "TEXT NOT NULL DEFAULT ''",
+                    "password_enc": "TEXT NOT NULL DEFAULT ''",
+                },
+            )
+            await self.seed_plans()
+            await self._commit()
+
+            # The partial indexes are only picked reliably with statistics; a full ANALYZE is needed once, later runs refresh cheaply.
+            await self.conn.execute("PRAGMA analysis_limit = 400;")
+            stats = await self.conn.execute_fetchall("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")
+            if stats:
+                await self.conn.execute("PRAGMA optimize;")
+            else:
+                await self.conn.execute("ANALYZE;")
+
+    async def _add_missing_columns(self, table: str, columns: dict[str, str]) -> None:
+        rows = await self.conn.execute_fetchall(f"PRAGMA table_info({table})")
+        existing = {row["name"] for row in rows}
+        for name, definition in columns.items():
+            if name not in existing:
+                await self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
 
     async def seed_plans(self) -> None:
-        for plan in DEFAULT_PLANS:
-            await self.conn.execute(
+        self._plan_cache = None
+        async with self.transaction():
+            await self.conn.executemany(
                 """
                 INSERT INTO plans (code, title, devices_count, price_rub, duration_days)
                 VALUES (?, ?, ?, ?, ?)
@@ -184,42 +375,49 @@ class Database:
                     price_rub = excluded.price_rub,
                     duration_days = excluded.duration_days
                 """,
-                (plan.code, plan.title, plan.devices_count, plan.price_rub, plan.duration_days),
+                [(plan.code, plan.title, plan.devices_count, plan.price_rub, plan.duration_days) for plan in DEFAULT_PLANS],
             )
 
     async def sync_proxy_pool(self, entries: list[ProxyPoolEntry]) -> None:
         timestamp = now_ts()
-        for item in entries:
-            await self.conn.execute(
+        rows = [
+            (
+                item.port,
+                item.username,
+                item.password,
+                quote(item.username, safe=""),
+                quote(item.password, safe=""),
+                timestamp,
+                timestamp,
+            )
+            for item in entries
+        ]
+        ports = json.dumps([item.port for item in entries])
+        async with self.transaction():
+            await self.conn.executemany(
                 """
-                INSERT INTO proxy_pool (port, username, password, status, created_at, updated_at)
-                VALUES (?, ?, ?, 'free', ?, ?)
+                INSERT INTO proxy_pool (
+                    port, username, password, username_enc, password_enc, status, created_at, updated_at
+                )
+                VALUES (?, ?, ?, ?, ?, 'free', ?, ?)
                 ON CONFLICT(port) DO UPDATE SET
                     username = excluded.username,
                     password = excluded.password,
+                    username_enc = excluded.username_enc,
+                    password_enc = excluded.password_enc,
                     updated_at = excluded.updated_at
                 """,
-                (item.port, item.username, item.password, timestamp, timestamp),
+                rows,
             )
 
-        ports = [item.port for item in entries]
-        if ports:
-            placeholders = ",".join("?" for _ in ports)
-            await self.conn.execute(
-                f"""
-                DELETE FROM proxy_pool
-                WHERE status = 'free' AND port NOT IN ({placeholders})
-                """,
-                tuple(ports),
-            )
-        else:
+            # A JSON array keeps the statement text fixed whatever the pool size (and clears every free row when empty).
             await self.conn.execute(
                 """
                 DELETE FROM proxy_pool
-                WHERE status = 'free'
-                """
+                WHERE status = 'free' AND port NOT IN (SELECT value FROM json_each(?))
+                """,
+                (ports,),
             )
-        await self.conn.commit()
 
     async def upsert_user(
         self,
@@ -229,31 +427,50 @@ class Database:
         last_name: str | None,
     ) -> int:
         timestamp = now_ts()
-        await self.conn.execute(
-            """
-            INSERT INTO users (tg_user_id, username, first_name, last_name, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?)
-            ON CONFLICT(tg_user_id) DO UPDATE SET
-                username = excluded.username,
-                first_name = excluded.first_name,
-                last_name = excluded.last_name,
-                updated_at = excluded.updated_at
-            """,
-            (tg_user_id, username, first_name, last_name, timestamp, timestamp),
-        )
-        cursor = await self.conn.execute(
-            "SELECT id FROM users WHERE tg_user_id = ?",
-            (tg_user_id,),
-        )
-        row = await cursor.fetchone()
-        await cursor.close()
-        await self.conn.commit()
+        async with self._writing():
+            rows = await self.conn.execute_fetchall(
+                """
+                INSERT INTO users (tg_user_id, username, first_name, last_name, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(tg_user_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    last_name = excluded.last_name,
+                    updated_at = excluded.updated_at
+                RETURNING id
+                """,
+                (tg_user_id, username, first_name, last_name, timestamp, timestamp),
+            )
+            row = rows[0] if rows else None
+            in_transaction = self._tx_depth > 0
+            await self._commit()
         if row is None:
             raise RuntimeError("Failed to upsert user.")
-        return int(row["id"])
+        user_id = int(row["id"])
+        # Inside a transaction the row may still be rolled back, so its id is not remembered.
+        if not in_transaction:
+            self._remember_user(tg_user_id, user_id, (username, first_name, last_name))
+        return user_id
+
+    def cached_user_id(
+        self,
+        tg_user_id: int,
+        username: str | None,
+        first_name: str | None,
+        last_name: str | None,
+    ) -> int | None:
+        cached = self._user_cache.get(tg_user_id)
+        if cached is not None and cached[0] > time.monotonic() and cached[2] == (username, first_name, last_name):
+            return cached[1]
+        return None
+
+    def _remember_user(self, tg_user_id: int, user_id: int, snapshot: tuple[str | None, str | None, str | None]) -> None:
+        if len(self._user_cache) >= USER_CACHE_MAX_SIZE:
+            self._user_cache.clear()
+        self._user_cache[tg_user_id] = (time.monotonic() + USER_CACHE_TTL_SECONDS, user_id, snapshot)
 
     async def get_user_by_tg_user_id(self, tg_user_id: int) -> dict[str, Any] | None:
-        cursor = await self.conn.execute(
+        rows = await self._read(
             """
             SELECT id, tg_user_id, username, first_name, last_name, created_at, updated_at
             FROM users
@@ -261,26 +478,43 @@ class Database:
             """,
             (tg_user_id,),
         )
-        row = await cursor.fetchone()
-        await cursor.close()
-        return dict(row) if row is not None else None
+        return dict(rows[0]) if rows else None
 
-    async def get_all_tg_user_ids(self) -> list[int]:
-        cursor = await self.conn.execute(
+    async def iter_all_tg_user_ids(self) -> AsyncIterator[int]:
+        # Keyset pages: each page is a short read, so no reader or snapshot is held while the caller works.
+        last_id = 0
+        while rows := await self._read(
             """
-            SELECT tg_user_id
+            SELECT id, tg_user_id
             FROM users
+            WHERE id > ?
             ORDER BY id ASC
-            """
-        )
-        rows = await cursor.fetchall()
-        await cursor.close()
-        return [int(row["tg_user_id"]) for row in rows]
+            LIMIT 1000
+            """,
+            (last_id,),
+        ):
+            for row in rows:
+                yield int(row["tg_user_id"])
+            last_id = int(rows[-1]["id"])
 
-    async def list_users_with_stats(self, limit: int = 200, offset: int = 0) -> list[dict[str, Any]]:
+    async def get_all_tg_user_ids(self) -> list[int]:
+        return [tg_user_id async for tg_user_id in self.iter_all_tg_user_ids()]
+
+    async def list_users_with_stats(
+        self,
+        limit: int = 200,
+        before: tuple[int, int] | None = None,
+    ) -> list[dict[str, Any]]:
+        # Keyset pagination: pass (created_at, id) of the last row seen to get the next page.
         timestamp = now_ts()
-        cursor = await self.conn.execute(
-            """
+        params: list[Any] = [timestamp]
+        keyset = ""
+        if before is not None:
+            keyset = "WHERE (u.created_at, u.id) < (?, ?)"
+            params.extend(before)
+        params.append(max(1, limit))
+        rows = await self._read(
+            f"""
             SELECT
                 u.id,
                 u.tg_user_id,
@@ -294,72 +528,53 @@ class Database:
             FROM users u
             LEFT JOIN proxy_links pl ON pl.user_id = u.id
             LEFT JOIN banned_users bu ON bu.tg_user_id = u.tg_user_id
+            {keyset}
             GROUP BY u.id, bu.tg_user_id
-            ORDER BY u.created_at DESC
-            LIMIT ? OFFSET ?
+            ORDER BY u.created_at DESC, u.id DESC
+            LIMIT ?
             """,
-            (timestamp, max(1, limit), max(0, offset)),
+            tuple(params),
         )
-        rows = await cursor.fetchall()
-        await cursor.close()
         return [dict(row) for row in rows]
 
+    async def _load_plans(self) -> dict[str, Plan]:
+        # Plans only change via seed_plans() at startup, so they are read once and served from memory.
+        if self._plan_cache is None:
+            rows = await self._read(
+                """
+                SELECT code, title, devices_count, price_rub, duration_days
+                FROM plans
+                ORDER BY devices_count ASC
+                """
+            )
+            # Columns are selected in Plan field order and the numeric ones are INTEGER, so rows unpack as-is.
+            plans = [Plan(*row) for row in rows]
+            self._plan_cache = {plan.code: plan for plan in plans}
+        return self._plan_cache
+
     async def get_plan(self, code: str) -> Plan | None:
-        cursor = await self.conn.execute(
-            """
-            SELECT code, title, devices_count, price_rub, duration_days
-            FROM plans
-            WHERE code = ?
-            """,
-            (code,),
-        )
-        row = await cursor.fetchone()
-        await cursor.close()
-        if row is None:
-            return None
-        return Plan(
-            code=row["code"],
-            title=row["title"],
-            devices_count=int(row["devices_count"]),
-            price_rub=int(row["price_rub"]),
-            duration_days=int(row["duration_days"]),
-        )
+        plans = await self._load_plans()
+        return plans.get(code)
 
     async def get_plans(self) -> list[Plan]:
-        cursor = await self.conn.execute(
-            """
-            SELECT code, title, devices_count, price_rub, duration_days
-            FROM plans
-            ORDER BY devices_count ASC
-            """
-        )
-        rows = await cursor.fetchall()
-        await cursor.close()
-        return [
-            Plan(
-                code=row["code"],
-                title=row["title"],
-                devices_count=int(row["devices_count"]),
-                price_rub=int(row["price_rub"]),
-                duration_days=int(row["duration_days"]),
-            )
-            for row in rows
-        ]
+        plans = await self._load_plans()
+        return list(plans.values())
 
     async def create_payment(self, user_id: int, plan_code: str, amount_rub: int) -> int:
-        cursor = await self.conn.execute(
-            """
-            INSERT INTO payments (user_id, plan_code, amount_rub, status, created_at)
-            VALUES (?, ?, ?, 'pending', ?)
-            """,
-            (user_id, plan_code, amount_rub, now_ts()),
-        )
-        payment_id = int(cursor.lastrowid)
-        await self.conn.commit()
+        async with self._writing():
+            cursor = await self.conn.execute(
+                """
+                INSERT INTO payments (user_id, plan_code, amount_rub, status, created_at)
+                VALUES (?, ?, ?, 'pending', ?)
+                """,
+                (user_id, plan_code, amount_rub, now_ts()),
+            )
+            payment_id = int(cursor.lastrowid)
+            await self._commit()
         return payment_id
 
-    async def get_payment_for_user(self, payment_id: int, user_id: int) -> dict[str, Any] | None:
-        cursor = await self.conn.execute(
+    async def get_payment_for_user(self, payment_id: int, user_id: int) -> aiosqlite.Row | None:
+        rows = await self._read(
             """
             SELECT id, user_id, plan_code, amount_rub, status, created_at, paid_at
             FROM payments
@@ -367,29 +582,24 @@ class Database:
             """,
             (payment_id, user_id),
         )
-        row = await cursor.fetchone()
-        await cursor.close()
-        return dict(row) if row is not None else None
+        return rows[0] if rows else None
 
     async def cancel_pending_payment(self, payment_id: int, user_id: int) -> bool:
-        cursor = await self.conn.execute(
-            """
-            UPDATE payments
-            SET status = 'cancelled'
-            WHERE id = ? AND user_id = ? AND status = 'pending'
-            """,
-            (payment_id, user_id),
-        )
-        await self.conn.commit()
+        async with self._writing():
+            cursor = await self.conn.execute(
+                """
+                UPDATE payments
+                SET status = 'cancelled'
+                WHERE id = ? AND user_id = ? AND status = 'pending'
+                """,
+                (payment_id, user_id),
+            )
+            await self._commit()
         return cursor.rowcount > 0
 
     async def count_free_pool(self) -> int:
-        cursor = await self.conn.execute(
-            "SELECT COUNT(*) AS cnt FROM proxy_pool WHERE status = 'free'"
-        )
-        row = await cursor.fetchone()
-        await cursor.close()
-        return int(row["cnt"]) if row is not None else 0
+        rows = await self._read("SELECT COUNT(*) AS cnt FROM proxy_pool WHERE status = 'free'")
+        return int(rows[0]["cnt"]) if rows else 0
 
     async def activate_payment_and_create_subscription_from_pool(
         self,
@@ -402,8 +612,7 @@ class Database:
         proxy_public_host: str,
     ) -> tuple[int, list[dict[str, Any]]] | None:
         timestamp = now_ts()
-        await self.conn.execute("BEGIN IMMEDIATE")
-        try:
+        async with self.transaction() as tx:
             cursor = await self.conn.execute(
                 """
                 UPDATE payments
@@ -413,23 +622,28 @@ class Database:
                 (timestamp, payment_id, user_id),
             )
             if cursor.rowcount == 0:
-                await self.conn.rollback()
+                await tx.rollback()
                 return None
 
-            cursor = await self.conn.execute(
+            # Claim the rows in the same statement that picks them; RETURNING order is unspecified, so re-sort.
+            claimed_rows = await self.conn.execute_fetchall(
                 """
-                SELECT id, port, username, password
-                FROM proxy_pool
-                WHERE status = 'free'
-                ORDER BY port ASC
-                LIMIT ?
+                UPDATE proxy_pool
+                SET status = 'assigned', updated_at = ?
+                WHERE id IN (
+                    SELECT id
+                    FROM proxy_pool
+                    WHERE status = 'free'
+                    ORDER BY port ASC
+                    LIMIT ?
+                )
+                RETURNING id, port, username, password, username_enc, password_enc
                 """,
-                (devices_count,),
+                (timestamp, devices_count),
             )
-            proxy_rows = await cursor.fetchall()
-            await cursor.close()
+            proxy_rows = sorted(claimed_rows, key=lambda row: int(row["port"]))
             if len(proxy_rows) < devices_count:
-                await self.conn.rollback()
+                await tx.rollback()
                 return None
 
             cursor = await self.conn.execute(
@@ -442,48 +656,27 @@ class Database:
             subscription_id = int(cursor.lastrowid)
 
             created: list[dict[str, Any]] = []
-            for device_number, proxy_row in enumerate(proxy_rows, start=1):
+            link_params: list[Any] = []
+            tokens = new_link_tokens(len(proxy_rows))
+            for device_number, (proxy_row, token) in enumerate(zip(proxy_rows, tokens), start=1):
                 port = int(proxy_row["port"])
                 username = str(proxy_row["username"])
                 password = str(proxy_row["password"])
+                link = f"socks5://{proxy_row['username_enc']}:{proxy_row['password_enc']}@{proxy_public_host}:{port}"
 
-                username_safe = quote(username, safe="")
-                password_safe = quote(password, safe="")
-                link = f"socks5://{username_safe}:{password_safe}@{proxy_public_host}:{port}"
-
-                cursor = await self.conn.execute(
-                    """
-                    INSERT INTO proxy_links (
-                        subscription_id, user_id, device_number, token, link, status, created_at, expires_at
-                    )
-                    VALUES (?, ?, ?, ?, ?, 'active', ?, ?)
-                    """,
+                link_params.extend(
                     (
                         subscription_id,
                         user_id,
                         device_number,
-                        secrets.token_urlsafe(18),
+                        token,
                         link,
                         timestamp,
                         expires_at,
-                    ),
-                )
-                link_id = int(cursor.lastrowid)
-
-                updated = await self.conn.execute(
-                    """
-                    UPDATE proxy_pool
-                    SET status = 'assigned', assigned_link_id = ?, updated_at = ?
-                    WHERE id = ? AND status = 'free'
-                    """,
-                    (link_id, timestamp, int(proxy_row["id"])),
+                    )
                 )
-                if updated.rowcount == 0:
-                    raise RuntimeError("Failed to assign proxy from pool")
-
                 created.append(
                     {
-                        "proxy_id": link_id,
                         "device_number": device_number,
                         "port": port,
                         "username": username,
@@ -492,11 +685,33 @@ class Database:
                     }
                 )
 
-            await self.conn.commit()
+            # One multi-row INSERT: executemany cannot hand back RETURNING rows.
+            values = ",".join("(?, ?, ?, ?, ?, 'active', ?, ?)" for _ in proxy_rows)
+            link_rows = await self.conn.execute_fetchall(
+                f"""
+                INSERT INTO proxy_links (
+                    subscription_id, user_id, device_number, token, link, status, created_at, expires_at
+                )
+                VALUES {values}
+                RETURNING id, device_number
+                """,
+                link_params,
+            )
+            link_ids = {int(row["device_number"]): int(row["id"]) for row in link_rows}
+
+            for item in created:
+                item["proxy_id"] = link_ids[item["device_number"]]
+
+            await self.conn.executemany(
+                """
+                UPDATE proxy_pool
+                SET assigned_link_id = ?
+                WHERE id = ?
+                """,
+                [(item["proxy_id"], int(proxy_row["id"])) for item, proxy_row in zip(created, proxy_rows)],
+            )
+
             return subscription_id, created
-        except Exception:
-            await self.conn.rollback()
-            raise
 
     async def log_proxy_delivery(
         self,
@@ -510,77 +725,74 @@ class Database:
         delivery_source: str,
         proxy_url: str,
     ) -> None:
-        await self.conn.execute(
-            """
-            INSERT INTO proxy_delivery_logs (
-                proxy_link_id,
-                user_id,
-                tg_user_id,
-                user_label,
-                subscription_id,
-                device_number,
-                delivery_source,
-                proxy_url,
-                delivered_at
+        async with self._writing():
+            await self.conn.execute(
+                """
+                INSERT INTO proxy_delivery_logs (
+                    proxy_link_id,
+                    user_id,
+                    tg_user_id,
+                    user_label,
+                    subscription_id,
+                    device_number,
+                    delivery_source,
+                    proxy_url,
+                    delivered_at
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    proxy_link_id,
+                    user_id,
+                    tg_user_id,
+                    user_label,
+                    subscription_id,
+                    device_number,
+                    delivery_source,
+                    proxy_url,
+                    now_ts(),
+                ),
             )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                proxy_link_id,
-                user_id,
-                tg_user_id,
-                user_label,
-                subscription_id,
-                device_number,
-                delivery_source,
-                proxy_url,
-                now_ts(),
-            ),
-        )
-        await self.conn.commit()
+            await self._commit()
 
-    async def add_temp_message(
+    async def add_temp_messages(
         self,
         *,
         user_id: int,
         tg_user_id: int,
-        message_id: int,
+        message_ids: list[int],
         kind: str,
     ) -> None:
-        await self.conn.execute(
-            """
-            INSERT OR IGNORE INTO user_temp_messages (user_id, tg_user_id, message_id, kind, created_at)
-            VALUES (?, ?, ?, ?, ?)
-            """,
-            (user_id, tg_user_id, message_id, kind, now_ts()),
-        )
-        await self.conn.commit()
+        timestamp = now_ts()
+        async with self._writing():
+            await self.conn.executemany(
+                """
+                INSERT OR IGNORE INTO user_temp_messages (user_id, tg_user_id, message_id, kind, created_at)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                [(user_id, tg_user_id, message_id, kind, timestamp) for message_id in message_ids],
+            )
+            await self._commit()
 
     async def pop_temp_messages(self, *, user_id: int, kind: str) -> list[dict[str, Any]]:
-        cursor = await self.conn.execute(
-            """
-            SELECT id, tg_user_id, message_id
-            FROM user_temp_messages
-            WHERE user_id = ? AND kind = ?
-            ORDER BY id ASC
-            """,
-            (user_id, kind),
-        )
-        rows = await cursor.fetchall()
-        await cursor.close()
-        if rows:
-            await self.conn.execute(
+        async with self._writing():
+            rows = await self.conn.execute_fetchall(
                 """
                 DELETE FROM user_temp_messages
                 WHERE user_id = ? AND kind = ?
+                RETURNING id, tg_user_id, message_id
                 """,
                 (user_id, kind),
             )
-            await self.conn.commit()
-        return [dict(row) for row in rows]
+            await self._commit()
+        # RETURNING order is unspecified in SQLite.
+        return sorted((dict(row) for row in rows), key=lambda row: int(row["id"]))
 
     async def get_user_ban(self, tg_user_id: int) -> dict[str, Any] | None:
-        cursor = await self.conn.execute(
+        cached = self._ban_cache.get(tg_user_id)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        rows = await self._read(
             """
             SELECT tg_user_id, reason, blocked_by, blocked_at
             FROM banned_users
@@ -588,37 +800,43 @@ class Database:
             """,
             (tg_user_id,),
         )
-        row = await cursor.fetchone()
-        await cursor.close()
-        return dict(row) if row is not None else None
+        ban = dict(rows[0]) if rows else None
+        if len(self._ban_cache) >= BAN_CACHE_MAX_SIZE:
+            self._ban_cache.clear()
+        self._ban_cache[tg_user_id] = (time.monotonic() + BAN_CACHE_TTL_SECONDS, ban)
+        return ban
 
     async def ban_user(self, tg_user_id: int, reason: str, blocked_by: int | None = None) -> None:
-        await self.conn.execute(
-            """
-            INSERT INTO banned_users (tg_user_id, reason, blocked_by, blocked_at)
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(tg_user_id) DO UPDATE SET
-                reason = excluded.reason,
-                blocked_by = excluded.blocked_by,
-                blocked_at = excluded.blocked_at
-            """,
-            (tg_user_id, reason, blocked_by, now_ts()),
-        )
-        await self.conn.commit()
+        async with self._writing():
+            await self.conn.execute(
+                """
+                INSERT INTO banned_users (tg_user_id, reason, blocked_by, blocked_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(tg_user_id) DO UPDATE SET
+                    reason = excluded.reason,
+                    blocked_by = excluded.blocked_by,
+                    blocked_at = excluded.blocked_at
+                """,
+                (tg_user_id, reason, blocked_by, now_ts()),
+            )
+            await self._commit()
+        self._ban_cache.pop(tg_user_id, None)
 
     async def unban_user(self, tg_user_id: int) -> bool:
-        cursor = await self.conn.execute(
-            """
-            DELETE FROM banned_users
-            WHERE tg_user_id = ?
-            """,
-            (tg_user_id,),
-        )
-        await self.conn.commit()
+        async with self._writing():
+            cursor = await self.conn.execute(
+                """
+                DELETE FROM banned_users
+                WHERE tg_user_id = ?
+                """,
+                (tg_user_id,),
+            )
+            await self._commit()
+        self._ban_cache.pop(tg_user_id, None)
         return cursor.rowcount > 0
 
-    async def get_all_links_for_user(self, user_id: int) -> list[dict[str, Any]]:
-        cursor = await self.conn.execute(
+    async def get_all_links_for_user(self, user_id: int) -> list[aiosqlite.Row]:
+        return await self._read(
             """
             SELECT
                 pl.id,
@@ -637,13 +855,10 @@ class Database:
             """,
             (user_id,),
         )
-        rows = await cursor.fetchall()
-        await cursor.close()
-        return [dict(row) for row in rows]
 
-    async def get_active_links_for_user(self, user_id: int) -> list[dict[str, Any]]:
+    async def get_active_links_for_user(self, user_id: int) -> list[aiosqlite.Row]:
         timestamp = now_ts()
-        cursor = await self.conn.execute(
+        return await self._read(
             """
             SELECT
                 pl.id,
@@ -664,13 +879,10 @@ class Database:
             """,
             (user_id, timestamp),
         )
-        rows = await cursor.fetchall()
-        await cursor.close()
-        return [dict(row) for row in rows]
 
-    async def get_active_subscriptions_for_user(self, user_id: int) -> list[dict[str, Any]]:
+    async def get_active_subscriptions_for_user(self, user_id: int) -> list[aiosqlite.Row]:
         timestamp = now_ts()
-        cursor = await self.conn.execute(
+        return await self._read(
             """
             SELECT
                 s.id,
@@ -686,15 +898,11 @@ class Database:
             """,
             (user_id, timestamp),
         )
-        rows = await cursor.fetchall()
-        await cursor.close()
-        return [dict(row) for row in rows]
 
     async def revoke_proxy_link_for_user(self, user_id: int, proxy_link_id: int) -> bool:
         timestamp = now_ts()
-        await self.conn.execute("BEGIN IMMEDIATE")
-        try:
-            cursor = await self.conn.execute(
+        async with self.transaction() as tx:
+            rows = await self.conn.execute_fetchall(
                 """
                 SELECT id, subscription_id
                 FROM proxy_links
@@ -702,10 +910,9 @@ class Database:
                 """,
                 (proxy_link_id, user_id),
             )
-            row = await cursor.fetchone()
-            await cursor.close()
+            row = rows[0] if rows else None
             if row is None:
-                await self.conn.rollback()
+                await tx.rollback()
                 return False
 
             subscription_id = int(row["subscription_id"])
@@ -738,48 +945,31 @@ class Database:
                 """,
                 (subscription_id, subscription_id, timestamp),
             )
-            await self.conn.commit()
             return True
-        except Exception:
-            await self.conn.rollback()
-            raise
 
     async def revoke_all_active_links_for_user(self, user_id: int) -> int:
         timestamp = now_ts()
-        await self.conn.execute("BEGIN IMMEDIATE")
-        try:
-            cursor = await self.conn.execute(
+        async with self.transaction() as tx:
+            rows = await self.conn.execute_fetchall(
                 """
-                SELECT id
-                FROM proxy_links
+                UPDATE proxy_links
+                SET status = 'expired', expires_at = ?
                 WHERE user_id = ? AND status = 'active' AND expires_at > ?
+                RETURNING id
                 """,
-                (user_id, timestamp),
+                (timestamp, user_id, timestamp),
             )
-            rows = await cursor.fetchall()
-            await cursor.close()
             if not rows:
-                await self.conn.rollback()
+                await tx.rollback()
                 return 0
 
-            link_ids = [int(row["id"]) for row in rows]
-            placeholders = ",".join("?" for _ in link_ids)
-
-            await self.conn.execute(
-                f"""
-                UPDATE proxy_links
-                SET status = 'expired', expires_at = ?
-                WHERE id IN ({placeholders})
-                """,
-                (timestamp, *link_ids),
-            )
-            await self.conn.execute(
-                f"""
+            await self.conn.executemany(
+                """
                 UPDATE proxy_pool
                 SET status = 'free', assigned_link_id = NULL, updated_at = ?
-                WHERE assigned_link_id IN ({placeholders})
+                WHERE assigned_link_id = ?
                 """,
-                (timestamp, *link_ids),
+                [(timestamp, int(row["id"])) for row in rows],
             )
             await self.conn.execute(
                 """
@@ -793,59 +983,47 @@ class Database:
                 """,
                 (user_id, timestamp),
             )
-            await self.conn.commit()
-            return len(link_ids)
-        except Exception:
-            await self.conn.rollback()
-            raise
+            return len(rows)
 
     async def expire_due_and_get_notified_users(self) -> list[int]:
         timestamp = now_ts()
-        await self.conn.execute(
-            """
-            UPDATE subscriptions
-            SET status = 'expired'
-            WHERE status = 'active' AND expires_at <= ?
-            """,
-            (timestamp,),
-        )
-        await self.conn.execute(
-            """
-            UPDATE proxy_links
-            SET status = 'expired'
-            WHERE status = 'active' AND expires_at <= ?
-            """,
-            (timestamp,),
-        )
-        await self.conn.execute(
-            """
-            UPDATE proxy_pool
-            SET status = 'free', assigned_link_id = NULL, updated_at = ?
-            WHERE assigned_link_id IN (
-                SELECT id FROM proxy_links WHERE status = 'expired'
+        # One write transaction for all three tables: a single fsync, and no writer can slip in between steps.
+        async with self.transaction():
+            # Due subscriptions and ones already expired by a revoke are closed and marked notified in one pass.
+            user_rows = await self.conn.execute_fetchall(
+                """
+                UPDATE subscriptions
+                SET status = 'expired', notified_expired = 1
+                WHERE (status = 'active' AND expires_at <= ?)
+                   OR (status = 'expired' AND notified_expired = 0)
+                RETURNING (SELECT tg_user_id FROM users WHERE users.id = subscriptions.user_id) AS tg_user_id
+                """,
+                (timestamp,),
             )
-            """,
-            (timestamp,),
-        )
 
-        cursor = await self.conn.execute(
-            """
-            SELECT DISTINCT u.tg_user_id
-            FROM subscriptions s
-            JOIN users u ON u.id = s.user_id
-            WHERE s.status = 'expired' AND s.notified_expired = 0
-            """
-        )
-        rows = await cursor.fetchall()
-        await cursor.close()
+            link_rows = await self.conn.execute_fetchall(
+                """
+                UPDATE proxy_links
+                SET status = 'expired'
+                WHERE status = 'active' AND expires_at <= ?
+                RETURNING id
+                """,
+                (timestamp,),
+            )
 
-        await self.conn.execute(
-            """
-            UPDATE subscriptions
-            SET notified_expired = 1
-            WHERE status = 'expired' AND notified_expired = 0
-            """
-        )
-        await self.conn.commit()
+            if link_rows:
+                await self.conn.executemany(
+                    """
+                    UPDATE proxy_pool
+                    SET status = 'free', assigned_link_id = NULL, updated_at = ?
+                    WHERE assigned_link_id = ?
+                    """,
+                    [(timestamp, int(row["id"])) for row in link_rows],
+                )
+
+        if time.monotonic() - self._last_checkpoint_at >= WAL_CHECKPOINT_INTERVAL_SECONDS:
+            self._last_checkpoint_at = time.monotonic()
+            async with self._writing():
+                await self.conn.execute("PRAGMA wal_checkpoint(PASSIVE);")
 
-        return [int(row["tg_user_id"]) for row in rows]
+        return list(dict.fromkeys(int(row["tg_user_id"]) for row in user_rows))
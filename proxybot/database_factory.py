@@ -4,7 +4,20 @@ from .database import Database
 from .database_postgres import PostgresDatabase
 
 
-def create_database(*, database_url: str, database_path: str) -> Database | PostgresDatabase:
-    if database_url.strip():
-        return PostgresDatabase(database_url.strip())
+def create_database(
+    *,
+    database_url: str,
+    database_path: str,
+    pool_min_size: int = 4,
+    pool_max_size: int = 32,
+    async_expiry_commit: bool = False,
+) -> Database | PostgresDatabase:
+    dsn = database_url.strip()
+    if dsn:
+        return PostgresDatabase(
+            dsn,
+            min_pool_size=pool_min_size,
+            max_pool_size=pool_max_size,
+            async_expiry_commit=async_expiry_commit,
+        )
     return Database(database_path)
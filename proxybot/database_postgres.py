@@ -1,38 +1,155 @@
 from __future__ import annotations
 
-import secrets
-from typing import Any
+import asyncio
+from contextlib import asynccontextmanager, nullcontext
+from contextvars import ContextVar
+import logging
+import time
+from typing import Any, AsyncIterator
 from urllib.parse import quote
 
-import psycopg
-from psycopg.rows import dict_row
-
-from .database import DEFAULT_PLANS, Plan, ProxyPoolEntry, now_ts
+import asyncpg
+
+from .database import (
+    BAN_CACHE_MAX_SIZE,
+    BAN_CACHE_TTL_SECONDS,
+    DEFAULT_PLANS,
+    USER_CACHE_MAX_SIZE,
+    USER_CACHE_TTL_SECONDS,
+    Plan,
+    ProxyPoolEntry,
+    new_link_tokens,
+    now_ts,
+)
+
+logger = logging.getLogger(__name__)
+
+EXPIRY_BATCH_SIZE = 1000
+DELIVERY_LOG_FLUSH_SECONDS = 0.1
+DELIVERY_LOG_BATCH_SIZE = 500
+DELIVERY_LOG_COLUMNS = [
+    "proxy_link_id",
+    "user_id",
+    "tg_user_id",
+    "user_label",
+    "subscription_id",
+    "device_number",
+    "delivery_source",
+    "proxy_url",
+    "delivered_at",
+]
+
+def _rowcount(status: str) -> int:
+    # asyncpg reports affected rows only in the command tag, e.g. "UPDATE 3".
+    return int(status.rsplit(" ", 1)[-1])
+
+
+class PostgresTransaction:
+    # Lets callers roll back early; leaving the scope afterwards is then a no-op.
+    def __init__(self, transaction: Any):
+        self._transaction = transaction
+        self.finished = False
+
+    async def commit(self) -> None:
+        if self.finished:
+            return
+        self.finished = True
+        await self._transaction.commit()
+
+    async def rollback(self) -> None:
+        if self.finished:
+            return
+        self.finished = True
+        await self._transaction.rollback()
 
 
 class PostgresDatabase:
-    def __init__(self, dsn: str):
+    def __init__(
+        self,
+        dsn: str,
+        min_pool_size: int = 4,
+        max_pool_size: int = 32,
+        async_expiry_commit: bool = False,
+    ):
         self.dsn = dsn
-        self._conn: psycopg.AsyncConnection | None = None
+        self.min_pool_size = min_pool_size
+        self.max_pool_size = max(min_pool_size, max_pool_size)
+        self.async_expiry_commit = async_expiry_commit
+        self._pool: asyncpg.Pool | None = None
+        self._plan_cache: dict[str, Plan] | None = None
+        # Every update checks the ban list; entries expire on their own and are dropped on ban/unban.
+        self._ban_cache: dict[int, tuple[float, asyncpg.Record | None]] = {}
+        # tg_user_id -> (expires at, users.id, profile fields last written); only committed upserts land here.
+        self._user_cache: dict[int, tuple[float, int, tuple[str | None, str | None, str | None]]] = {}
+        # (owning task, connection) of the current transaction() scope; spawned tasks inherit the var but not the connection.
+        self._tx_conn: ContextVar[tuple[asyncio.Task[Any] | None, asyncpg.Connection] | None] = ContextVar(
+            "postgres_tx_conn", default=None
+        )
+        # Delivery logs are written in the background; None tells the drain task to stop.
+        self._delivery_queue: asyncio.Queue[tuple[Any, ...] | None] = asyncio.Queue()
+        self._delivery_task: asyncio.Task[None] | None = None
 
     @property
-    def conn(self) -> psycopg.AsyncConnection:
-        if self._conn is None:
+    def pool(self) -> asyncpg.Pool:
+        if self._pool is None:
             raise RuntimeError("Database is not connected.")
-        return self._conn
+        return self._pool
 
     async def connect(self) -> None:
-        self._conn = await psycopg.AsyncConnection.connect(self.dsn, row_factory=dict_row)
-        await self._conn.set_autocommit(True)
+        # Handlers run concurrently; each gets its own backend instead of queueing behind one connection.
+        self._pool = await asyncpg.create_pool(self.dsn, min_size=self.min_pool_size, max_size=self.max_pool_size)
+        self._delivery_task = asyncio.create_task(self._drain_delivery_logs())
 
     async def close(self) -> None:
-        if self._conn is not None:
-            await self._conn.close()
-            self._conn = None
+        if self._delivery_task is not None:
+            self._delivery_queue.put_nowait(None)
+            await self._delivery_task
+            self._delivery_task = None
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    def _owned_tx_conn(self) -> asyncpg.Connection | None:
+        owned = self._tx_conn.get()
+        if owned is not None and owned[0] is asyncio.current_task():
+            return owned[1]
+        return None
+
+    @asynccontextmanager
+    async def _acquire(self) -> AsyncIterator[asyncpg.Connection]:
+        conn = self._owned_tx_conn()
+        if conn is not None:
+            yield conn
+            return
+        async with self.pool.acquire() as conn:
+            yield conn
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[PostgresTransaction]:
+        """Run this task's queries on one connection until the scope ends.
+
+        Tasks spawned inside the scope (create_task, gather) get their own pool connection, outside
+        this transaction; they may block on its row locks, so the scope must not wait for them.
+        """
+        # asyncpg turns a transaction opened inside another one into a savepoint.
+        async with self._acquire() as conn:
+            transaction = conn.transaction()
+            await transaction.start()
+            tx = PostgresTransaction(transaction)
+            token = self._tx_conn.set((asyncio.current_task(), conn))
+            try:
+                yield tx
+            except BaseException:
+                await tx.rollback()
+                raise
+            else:
+                await tx.commit()
+            finally:
+                self._tx_conn.reset(token)
 
     async def init_schema(self) -> None:
-        async with self.conn.cursor() as cur:
-            await cur.execute(
+        async with self._acquire() as conn:
+            await conn.execute(
                 """
                 CREATE TABLE IF NOT EXISTS users (
                     id BIGSERIAL PRIMARY KEY,
@@ -127,72 +244,92 @@ class PostgresDatabase:
                     blocked_at BIGINT NOT NULL
                 );
 
-                CREATE INDEX IF NOT EXISTS idx_users_tg_user_id ON users(tg_user_id);
+                DROP INDEX IF EXISTS idx_users_tg_user_id;
+                DROP INDEX IF EXISTS idx_users_created_at;
+                CREATE INDEX IF NOT EXISTS idx_users_created_at_id ON users(created_at, id);
                 CREATE INDEX IF NOT EXISTS idx_payments_user_status ON payments(user_id, status);
                 CREATE INDEX IF NOT EXISTS idx_subscriptions_user_status ON subscriptions(user_id, status);
-                CREATE INDEX IF NOT EXISTS idx_subscriptions_expires_at ON subscriptions(expires_at);
+                DROP INDEX IF EXISTS idx_subscriptions_expires_at;
+                CREATE INDEX IF NOT EXISTS idx_subscriptions_active_expires_at
+                    ON subscriptions(expires_at) WHERE status = 'active';
+                CREATE INDEX IF NOT EXISTS idx_subscriptions_expired_notified
+                    ON subscriptions(id) WHERE status = 'expired' AND notified_expired = 0;
                 CREATE INDEX IF NOT EXISTS idx_proxy_links_user_status ON proxy_links(user_id, status);
-                CREATE INDEX IF NOT EXISTS idx_proxy_links_expires_at ON proxy_links(expires_at);
-                CREATE INDEX IF NOT EXISTS idx_proxy_pool_status ON proxy_pool(status);
+                DROP INDEX IF EXISTS idx_proxy_links_active_user;
+                CREATE INDEX IF NOT EXISTS idx_proxy_links_active_user_covering ON proxy_links(user_id, expires_at)
+                    INCLUDE (id, subscription_id, device_number, link)
+                    WHERE status = 'active';
+                DROP INDEX IF EXISTS idx_proxy_links_expires_at;
+                CREATE INDEX IF NOT EXISTS idx_proxy_links_active_expires_at
+                    ON proxy_links(expires_at) WHERE status = 'active';
+                DROP INDEX IF EXISTS idx_proxy_pool_status;
+                CREATE INDEX IF NOT EXISTS idx_proxy_pool_free ON proxy_pool(port) WHERE status = 'free';
+                ALTER TABLE proxy_pool SET (autovacuum_vacuum_scale_factor = 0.02);
                 CREATE INDEX IF NOT EXISTS idx_proxy_delivery_logs_tg_user_id ON proxy_delivery_logs(tg_user_id);
                 CREATE INDEX IF NOT EXISTS idx_proxy_delivery_logs_proxy_link_id ON proxy_delivery_logs(proxy_link_id);
                 CREATE INDEX IF NOT EXISTS idx_user_temp_messages_user_kind ON user_temp_messages(user_id, kind);
-                CREATE INDEX IF NOT EXISTS idx_banned_users_tg_user_id ON banned_users(tg_user_id);
+                DROP INDEX IF EXISTS idx_banned_users_tg_user_id;
                 """
             )
         await self.seed_plans()
-        await self.conn.commit()
 
     async def seed_plans(self) -> None:
-        async with self.conn.cursor() as cur:
-            for plan in DEFAULT_PLANS:
-                await cur.execute(
+        self._plan_cache = None
+        async with self.transaction():
+            async with self._acquire() as conn:
+                await conn.executemany(
                     """
                     INSERT INTO plans (code, title, devices_count, price_rub, duration_days)
-                    VALUES (%s, %s, %s, %s, %s)
+                    VALUES ($1, $2, $3, $4, $5)
                     ON CONFLICT(code) DO UPDATE SET
                         title = EXCLUDED.title,
                         devices_count = EXCLUDED.devices_count,
                         price_rub = EXCLUDED.price_rub,
                         duration_days = EXCLUDED.duration_days
                     """,
-                    (plan.code, plan.title, plan.devices_count, plan.price_rub, plan.duration_days),
+                    [(plan.code, plan.title, plan.devices_count, plan.price_rub, plan.duration_days) for plan in DEFAULT_PLANS],
                 )
-        await self.conn.commit()
 
     async def sync_proxy_pool(self, entries: list[ProxyPoolEntry]) -> None:
         timestamp = now_ts()
-        async with self.conn.cursor() as cur:
-            for item in entries:
-                await cur.execute(
+        async with self.transaction():
+            async with self._acquire() as conn:
+                # The pool file is staged with binary COPY; upsert and delete then join against it.
+                await conn.execute(
+                    """
+                    CREATE TEMP TABLE IF NOT EXISTS _sync_ports (
+                        port INTEGER PRIMARY KEY,
+                        username TEXT NOT NULL,
+                        password TEXT NOT NULL
+                    ) ON COMMIT DROP;
+                    TRUNCATE _sync_ports;
+                    """
+                )
+                await conn.copy_records_to_table(
+                    "_sync_ports",
+                    records=[(item.port, item.username, item.password) for item in entries],
+                    columns=["port", "username", "password"],
+                )
+                await conn.execute(
                     """
                     INSERT INTO proxy_pool (port, username, password, status, created_at, updated_at)
-                    VALUES (%s, %s, %s, 'free', %s, %s)
+                    SELECT port, username, password, 'free', $1::bigint, $1::bigint
+                    FROM _sync_ports
                     ON CONFLICT(port) DO UPDATE SET
                         username = EXCLUDED.username,
                         password = EXCLUDED.password,
                         updated_at = EXCLUDED.updated_at
                     """,
-                    (item.port, item.username, item.password, timestamp, timestamp),
+                    timestamp,
                 )
-
-            ports = [item.port for item in entries]
-            if ports:
-                await cur.execute(
-                    """
-                    DELETE FROM proxy_pool
-                    WHERE status = 'free' AND NOT (port = ANY(%s))
-                    """,
-                    (ports,),
-                )
-            else:
-                await cur.execute(
+                # An empty staging table matches nothing, so an empty pool file clears every free row.
+                await conn.execute(
                     """
                     DELETE FROM proxy_pool
                     WHERE status = 'free'
+                      AND NOT EXISTS (SELECT 1 FROM _sync_ports WHERE _sync_ports.port = proxy_pool.port)
                     """
                 )
-        await self.conn.commit()
 
     async def upsert_user(
         self,
@@ -202,11 +339,11 @@ class PostgresDatabase:
         last_name: str | None,
     ) -> int:
         timestamp = now_ts()
-        async with self.conn.cursor() as cur:
-            await cur.execute(
+        async with self._acquire() as conn:
+            user_id = await conn.fetchval(
                 """
                 INSERT INTO users (tg_user_id, username, first_name, last_name, created_at, updated_at)
-                VALUES (%s, %s, %s, %s, %s, %s)
+                VALUES ($1, $2, $3, $4, $5, $6)
                 ON CONFLICT(tg_user_id) DO UPDATE SET
                     username = EXCLUDED.username,
                     first_name = EXCLUDED.first_name,
@@ -214,44 +351,82 @@ class PostgresDatabase:
                     updated_at = EXCLUDED.updated_at
                 RETURNING id
                 """,
-                (tg_user_id, username, first_name, last_name, timestamp, timestamp),
+                tg_user_id, username, first_name, last_name, timestamp, timestamp,
             )
-            row = await cur.fetchone()
-        await self.conn.commit()
-        if row is None:
+        if user_id is None:
             raise RuntimeError("Failed to upsert user.")
-        return int(row["id"])
+        # Inside a transaction the row may still be rolled back, so its id is not remembered.
+        if self._owned_tx_conn() is None:
+            self._remember_user(tg_user_id, int(user_id), (username, first_name, last_name))
+        return int(user_id)
 
-    async def get_user_by_tg_user_id(self, tg_user_id: int) -> dict[str, Any] | None:
-        async with self.conn.cursor() as cur:
-            await cur.execute(
+    def cached_user_id(
+        self,
+        tg_user_id: int,
+        username: str | None,
+        first_name: str | None,
+        last_name: str | None,
+    ) -> int | None:
+        cached = self._user_cache.get(tg_user_id)
+        if cached is not None and cached[0] > time.monotonic() and cached[2] == (username, first_name, last_name):
+            return cached[1]
+        return None
+
+    def _remember_user(self, tg_user_id: int, user_id: int, snapshot: tuple[str | None, str | None, str | None]) -> None:
+        if len(self._user_cache) >= USER_CACHE_MAX_SIZE:
+            self._user_cache.clear()
+        self._user_cache[tg_user_id] = (time.monotonic() + USER_CACHE_TTL_SECONDS, user_id, snapshot)
+
+    async def get_user_by_tg_user_id(self, tg_user_id: int) -> asyncpg.Record | None:
+        async with self._acquire() as conn:
+            return await conn.fetchrow(
                 """
                 SELECT id, tg_user_id, username, first_name, last_name, created_at, updated_at
                 FROM users
-                WHERE tg_user_id = %s
+                WHERE tg_user_id = $1
                 """,
-                (tg_user_id,),
+                tg_user_id,
             )
-            row = await cur.fetchone()
-        return dict(row) if row is not None else None
+
+    async def iter_all_tg_user_ids(self) -> AsyncIterator[int]:
+        # Keyset pages: the connection goes back to the pool between pages, so no transaction stays open.
+        last_id = 0
+        while True:
+            async with self._acquire() as conn:
+                rows = await conn.fetch(
+                    """
+                    SELECT id, tg_user_id
+                    FROM users
+                    WHERE id > $1
+                    ORDER BY id ASC
+                    LIMIT 1000
+                    """,
+                    last_id,
+                )
+            if not rows:
+                return
+            for row in rows:
+                yield int(row["tg_user_id"])
+            last_id = int(rows[-1]["id"])
 
     async def get_all_tg_user_ids(self) -> list[int]:
-        async with self.conn.cursor() as cur:
-            await cur.execute(
-                """
-                SELECT tg_user_id
-                FROM users
-                ORDER BY id ASC
-                """
-            )
-            rows = await cur.fetchall()
-        return [int(row["tg_user_id"]) for row in rows]
+        return [tg_user_id async for tg_user_id in self.iter_all_tg_user_ids()]
 
-    async def list_users_with_stats(self, limit: int = 200, offset: int = 0) -> list[dict[str, Any]]:
+    async def list_users_with_stats(
+        self,
+        limit: int = 200,
+        before: tuple[int, int] | None = None,
+    ) -> list[asyncpg.Record]:
+        # Keyset pagination: pass (created_at, id) of the last row seen to get the next page.
         timestamp = now_ts()
-        async with self.conn.cursor() as cur:
-            await cur.execute(
-                """
+        args: list[Any] = [timestamp, max(1, limit)]
+        keyset = ""
+        if before is not None:
+            keyset = "WHERE (u.created_at, u.id) < ($3, $4)"
+            args.extend(before)
+        async with self._acquire() as conn:
+            return await conn.fetch(
+                f"""
                 SELECT
                     u.id,
                     u.tg_user_id,
@@ -260,112 +435,88 @@ class PostgresDatabase:
                     u.last_name,
                     u.created_at,
                     u.updated_at,
-                    SUM(CASE WHEN pl.status = 'active' AND pl.expires_at > %s THEN 1 ELSE 0 END) AS active_proxies,
-                    CASE WHEN bu.tg_user_id IS NULL THEN 0 ELSE 1 END AS is_banned
+                    pl.active_proxies,
+                    EXISTS (SELECT 1 FROM banned_users bu WHERE bu.tg_user_id = u.tg_user_id)::int AS is_banned
                 FROM users u
-                LEFT JOIN proxy_links pl ON pl.user_id = u.id
-                LEFT JOIN banned_users bu ON bu.tg_user_id = u.tg_user_id
-                GROUP BY u.id, bu.tg_user_id
-                ORDER BY u.created_at DESC
-                LIMIT %s OFFSET %s
+                LEFT JOIN LATERAL (
+                    SELECT COUNT(*) AS active_proxies
+                    FROM proxy_links
+                    WHERE user_id = u.id AND status = 'active' AND expires_at > $1
+                ) pl ON true
+                {keyset}
+                ORDER BY u.created_at DESC, u.id DESC
+                LIMIT $2
                 """,
-                (timestamp, max(1, limit), max(0, offset)),
+                *args,
             )
-            rows = await cur.fetchall()
-        return [dict(row) for row in rows]
+
+    async def _load_plans(self) -> dict[str, Plan]:
+        # Plans only change via seed_plans() at startup, so they are read once and served from memory.
+        if self._plan_cache is None:
+            async with self._acquire() as conn:
+                rows = await conn.fetch(
+                    """
+                    SELECT code, title, devices_count, price_rub, duration_days
+                    FROM plans
+                    ORDER BY devices_count ASC
+                    """
+                )
+            plans = [Plan(*row) for row in rows]
+            self._plan_cache = {plan.code: plan for plan in plans}
+        return self._plan_cache
 
     async def get_plan(self, code: str) -> Plan | None:
-        async with self.conn.cursor() as cur:
-            await cur.execute(
-                """
-                SELECT code, title, devices_count, price_rub, duration_days
-                FROM plans
-                WHERE code = %s
-                """,
-                (code,),
-            )
-            row = await cur.fetchone()
-        if row is None:
-            return None
-        return Plan(
-            code=row["code"],
-            title=row["title"],
-            devices_count=int(row["devices_count"]),
-            price_rub=int(row["price_rub"]),
-            duration_days=int(row["duration_days"]),
-        )
+        plans = await self._load_plans()
+        return plans.get(code)
 
     async def get_plans(self) -> list[Plan]:
-        async with self.conn.cursor() as cur:
-            await cur.execute(
-                """
-                SELECT code, title, devices_count, price_rub, duration_days
-                FROM plans
-                ORDER BY devices_count ASC
-                """
-            )
-            rows = await cur.fetchall()
-        return [
-            Plan(
-                code=row["code"],
-                title=row["title"],
-                devices_count=int(row["devices_count"]),
-                price_rub=int(row["price_rub"]),
-                duration_days=int(row["duration_days"]),
-            )
-            for row in rows
-        ]
+        plans = await self._load_plans()
+        return list(plans.values())
 
     async def create_payment(self, user_id: int, plan_code: str, amount_rub: int) -> int:
-        async with self.conn.cursor() as cur:
-            await cur.execute(
+        async with self._acquire() as conn:
+            payment_id = await conn.fetchval(
                 """
                 INSERT INTO payments (user_id, plan_code, amount_rub, status, created_at)
-                VALUES (%s, %s, %s, 'pending', %s)
+                VALUES ($1, $2, $3, 'pending', $4)
                 RETURNING id
                 """,
-                (user_id, plan_code, amount_rub, now_ts()),
+                user_id, plan_code, amount_rub, now_ts(),
             )
-            row = await cur.fetchone()
-        await self.conn.commit()
-        if row is None:
+        if payment_id is None:
             raise RuntimeError("Failed to create payment.")
-        return int(row["id"])
+        return int(payment_id)
 
-    async def get_payment_for_user(self, payment_id: int, user_id: int) -> dict[str, Any] | None:
-        async with self.conn.cursor() as cur:
-            await cur.execute(
+    async def get_payment_for_user(self, payment_id: int, user_id: int) -> asyncpg.Record | None:
+        async with self._acquire() as conn:
+            return await conn.fetchrow(
                 """
                 SELECT id, user_id, plan_code, amount_rub, status, created_at, paid_at
                 FROM payments
-                WHERE id = %s AND user_id = %s
+                WHERE id = $1 AND user_id = $2
                 """,
-                (payment_id, user_id),
+                payment_id, user_id,
             )
-            row = await cur.fetchone()
-        return dict(row) if row is not None else None
 
     async def cancel_pending_payment(self, payment_id: int, user_id: int) -> bool:
-        async with self.conn.cursor() as cur:
-            await cur.execute(
+        async with self._acquire() as conn:
+            status = await conn.execute(
                 """
                 UPDATE payments
                 SET status = 'cancelled'
-                WHERE id = %s AND user_id = %s AND status = 'pending'
+                WHERE id = $1 AND user_id = $2 AND status = 'pending'
                 """,
-                (payment_id, user_id),
+                payment_id, user_id,
             )
-            changed = cur.rowcount > 0
-        await self.conn.commit()
+            changed = _rowcount(status) > 0
         return changed
 
     async def count_free_pool(self) -> int:
-        async with self.conn.cursor() as cur:
-            await cur.execute(
-                "SELECT COUNT(*) AS cnt FROM proxy_pool WHERE status = 'free'"
+        async with self._acquire() as conn:
+            count = await conn.fetchval(
+                "SELECT COUNT(*) FROM proxy_pool WHERE status = 'free'"
             )
-            row = await cur.fetchone()
-        return int(row["cnt"]) if row is not None else 0
+        return int(count)
 
     async def activate_payment_and_create_subscription_from_pool(
         self,
@@ -378,110 +529,104 @@ class PostgresDatabase:
         proxy_public_host: str,
     ) -> tuple[int, list[dict[str, Any]]] | None:
         timestamp = now_ts()
-        await self.conn.execute("BEGIN")
-        try:
-            async with self.conn.cursor() as cur:
-                await cur.execute(
-                    """
-                    UPDATE payments
-                    SET status = 'paid', paid_at = %s
-                    WHERE id = %s AND user_id = %s AND status = 'pending'
-                    """,
-                    (timestamp, payment_id, user_id),
-                )
-                if cur.rowcount == 0:
-                    await self.conn.rollback()
-                    return None
-
-                await cur.execute(
+        async with self.transaction() as tx:
+            async with self._acquire() as conn:
+                # Marking the payment paid and locking free ports is one round-trip; an unpaid payment claims nothing.
+                # No ORDER BY: concurrent activations skip each other's locked rows instead of all queueing on the lowest ports.
+                proxy_rows = await conn.fetch(
                     """
+                    WITH paid AS (
+                        UPDATE payments
+                        SET status = 'paid', paid_at = $1
+                        WHERE id = $2 AND user_id = $3 AND status = 'pending'
+                        RETURNING id
+                    )
                     SELECT id, port, username, password
                     FROM proxy_pool
-                    WHERE status = 'free'
-                    ORDER BY port ASC
-                    LIMIT %s
+                    WHERE status = 'free' AND EXISTS (SELECT 1 FROM paid)
+                    LIMIT $4
                     FOR UPDATE SKIP LOCKED
                     """,
-                    (devices_count,),
+                    timestamp, payment_id, user_id, devices_count,
                 )
-                proxy_rows = await cur.fetchall()
                 if len(proxy_rows) < devices_count:
-                    await self.conn.rollback()
+                    await tx.rollback()
                     return None
 
-                await cur.execute(
+                # Pool entries often share credentials, so each distinct value is percent-encoded once.
+                quoted: dict[str, str] = {}
+
+                def _q(value: str) -> str:
+                    if value not in quoted:
+                        quoted[value] = quote(value, safe="")
+                    return quoted[value]
+
+                tokens = new_link_tokens(len(proxy_rows))
+                created: list[dict[str, Any]] = [
+                    {
+                        "device_number": device_number,
+                        "port": int(proxy_row["port"]),
+                        "username": str(proxy_row["username"]),
+                        "password": str(proxy_row["password"]),
+                        "link": (
+                            f"socks5://{_q(str(proxy_row['username']))}:{_q(str(proxy_row['password']))}"
+                            f"@{proxy_public_host}:{int(proxy_row['port'])}"
+                        ),
+                    }
+                    for device_number, proxy_row in enumerate(proxy_rows, start=1)
+                ]
+
+                # Subscription, links and pool assignment in one statement; foreign keys are checked at its end.
+                link_rows = await conn.fetch(
                     """
-                    INSERT INTO subscriptions (user_id, plan_code, payment_id, status, created_at, expires_at)
-                    VALUES (%s, %s, %s, 'active', %s, %s)
-                    RETURNING id
-                    """,
-                    (user_id, plan_code, payment_id, timestamp, expires_at),
-                )
-                sub_row = await cur.fetchone()
-                if sub_row is None:
-                    raise RuntimeError("Failed to create subscription.")
-                subscription_id = int(sub_row["id"])
-
-                created: list[dict[str, Any]] = []
-                for device_number, proxy_row in enumerate(proxy_rows, start=1):
-                    port = int(proxy_row["port"])
-                    username = str(proxy_row["username"])
-                    password = str(proxy_row["password"])
-
-                    username_safe = quote(username, safe="")
-                    password_safe = quote(password, safe="")
-                    link = f"socks5://{username_safe}:{password_safe}@{proxy_public_host}:{port}"
-
-                    await cur.execute(
-                        """
+                    WITH subscription AS (
+                        INSERT INTO subscriptions (user_id, plan_code, payment_id, status, created_at, expires_at)
+                        VALUES ($1, $2, $3, 'active', $4, $5)
+                        RETURNING id
+                    ),
+                    device AS (
+                        SELECT *
+                        FROM unnest($6::integer[], $7::text[], $8::text[], $9::bigint[])
+                            AS device(device_number, token, link, pool_id)
+                    ),
+                    new_link AS (
                         INSERT INTO proxy_links (
                             subscription_id, user_id, device_number, token, link, status, created_at, expires_at
                         )
-                        VALUES (%s, %s, %s, %s, %s, 'active', %s, %s)
-                        RETURNING id
-                        """,
-                        (
-                            subscription_id,
-                            user_id,
-                            device_number,
-                            secrets.token_urlsafe(18),
-                            link,
-                            timestamp,
-                            expires_at,
-                        ),
-                    )
-                    link_row = await cur.fetchone()
-                    if link_row is None:
-                        raise RuntimeError("Failed to create proxy link.")
-                    link_id = int(link_row["id"])
-
-                    await cur.execute(
-                        """
+                        SELECT subscription.id, $1::bigint, device.device_number, device.token, device.link, 'active', $4::bigint, $5::bigint
+                        FROM subscription, device
+                        RETURNING id, subscription_id, device_number
+                    ),
+                    assigned AS (
                         UPDATE proxy_pool
-                        SET status = 'assigned', assigned_link_id = %s, updated_at = %s
-                        WHERE id = %s AND status = 'free'
-                        """,
-                        (link_id, timestamp, int(proxy_row["id"])),
-                    )
-                    if cur.rowcount == 0:
-                        raise RuntimeError("Failed to assign proxy from pool")
-
-                    created.append(
-                        {
-                            "proxy_id": link_id,
-                            "device_number": device_number,
-                            "port": port,
-                            "username": username,
-                            "password": password,
-                            "link": link,
-                        }
+                        SET status = 'assigned', assigned_link_id = new_link.id, updated_at = $4
+                        FROM new_link
+                        JOIN device USING (device_number)
+                        WHERE proxy_pool.id = device.pool_id AND proxy_pool.status = 'free'
+                        RETURNING proxy_pool.id
                     )
+                    SELECT new_link.id, new_link.subscription_id, new_link.device_number, (SELECT COUNT(*) FROM assigned) AS assigned
+                    FROM new_link
+                    """,
+                    user_id,
+                    plan_code,
+                    payment_id,
+                    timestamp,
+                    expires_at,
+                    [item["device_number"] for item in created],
+                    tokens,
+                    [item["link"] for item in created],
+                    [int(row["id"]) for row in proxy_rows],
+                )
+                if len(link_rows) != len(created) or int(link_rows[0]["assigned"]) != len(created):
+                    raise RuntimeError("Failed to assign proxy from pool")
+
+                subscription_id = int(link_rows[0]["subscription_id"])
+                link_ids = {int(row["device_number"]): int(row["id"]) for row in link_rows}
+                for item in created:
+                    item["proxy_id"] = link_ids[item["device_number"]]
 
-            await self.conn.commit()
             return subscription_id, created
-        except Exception:
-            await self.conn.rollback()
-            raise
 
     async def log_proxy_delivery(
         self,
@@ -495,122 +640,128 @@ class PostgresDatabase:
         delivery_source: str,
         proxy_url: str,
     ) -> None:
-        async with self.conn.cursor() as cur:
-            await cur.execute(
-                """
-                INSERT INTO proxy_delivery_logs (
-                    proxy_link_id,
-                    user_id,
-                    tg_user_id,
-                    user_label,
-                    subscription_id,
-                    device_number,
-                    delivery_source,
-                    proxy_url,
-                    delivered_at
-                )
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """,
-                (
-                    proxy_link_id,
-                    user_id,
-                    tg_user_id,
-                    user_label,
-                    subscription_id,
-                    device_number,
-                    delivery_source,
-                    proxy_url,
-                    now_ts(),
-                ),
+        # Purely observational, so the delivery does not wait for it; the drain task batches the inserts.
+        self._delivery_queue.put_nowait(
+            (
+                proxy_link_id,
+                user_id,
+                tg_user_id,
+                user_label,
+                subscription_id,
+                device_number,
+                delivery_source,
+                proxy_url,
+                now_ts(),
             )
-        await self.conn.commit()
+        )
+
+    async def _drain_delivery_logs(self) -> None:
+        stopping = False
+        while not stopping:
+            batch = [await self._delivery_queue.get()]
+            if batch[0] is not None:
+                await asyncio.sleep(DELIVERY_LOG_FLUSH_SECONDS)
+            while len(batch) < DELIVERY_LOG_BATCH_SIZE and not self._delivery_queue.empty():
+                batch.append(self._delivery_queue.get_nowait())
+            stopping = None in batch
+            records = [item for item in batch if item is not None]
+            if not records:
+                continue
+            try:
+                async with self.pool.acquire() as conn:
+                    await conn.copy_records_to_table(
+                        "proxy_delivery_logs",
+                        records=records,
+                        columns=DELIVERY_LOG_COLUMNS,
+                    )
+            except Exception:
+                logger.exception("Failed to write %d proxy delivery logs", len(records))
 
-    async def add_temp_message(
+    async def add_temp_messages(
         self,
         *,
         user_id: int,
         tg_user_id: int,
-        message_id: int,
+        message_ids: list[int],
         kind: str,
     ) -> None:
-        async with self.conn.cursor() as cur:
-            await cur.execute(
+        async with self._acquire() as conn:
+            await conn.execute(
                 """
                 INSERT INTO user_temp_messages (user_id, tg_user_id, message_id, kind, created_at)
-                VALUES (%s, %s, %s, %s, %s)
+                SELECT $1::bigint, $2::bigint, message_id, $4::text, $5::bigint
+                FROM unnest($3::bigint[]) AS message(message_id)
                 ON CONFLICT (user_id, message_id, kind) DO NOTHING
                 """,
-                (user_id, tg_user_id, message_id, kind, now_ts()),
+                user_id, tg_user_id, message_ids, kind, now_ts(),
             )
-        await self.conn.commit()
 
-    async def pop_temp_messages(self, *, user_id: int, kind: str) -> list[dict[str, Any]]:
-        async with self.conn.cursor() as cur:
-            await cur.execute(
+    async def pop_temp_messages(self, *, user_id: int, kind: str) -> list[asyncpg.Record]:
+        async with self._acquire() as conn:
+            # DELETE ... RETURNING has no ORDER BY of its own, so the popped rows are sorted by the outer SELECT.
+            return await conn.fetch(
                 """
+                WITH popped AS (
+                    DELETE FROM user_temp_messages
+                    WHERE user_id = $1 AND kind = $2
+                    RETURNING id, tg_user_id, message_id
+                )
                 SELECT id, tg_user_id, message_id
-                FROM user_temp_messages
-                WHERE user_id = %s AND kind = %s
+                FROM popped
                 ORDER BY id ASC
                 """,
-                (user_id, kind),
+                user_id, kind,
             )
-            rows = await cur.fetchall()
-            if rows:
-                await cur.execute(
-                    """
-                    DELETE FROM user_temp_messages
-                    WHERE user_id = %s AND kind = %s
-                    """,
-                    (user_id, kind),
-                )
-        await self.conn.commit()
-        return [dict(row) for row in rows]
 
-    async def get_user_ban(self, tg_user_id: int) -> dict[str, Any] | None:
-        async with self.conn.cursor() as cur:
-            await cur.execute(
+    async def get_user_ban(self, tg_user_id: int) -> asyncpg.Record | None:
+        cached = self._ban_cache.get(tg_user_id)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        async with self._acquire() as conn:
+            ban = await conn.fetchrow(
                 """
                 SELECT tg_user_id, reason, blocked_by, blocked_at
                 FROM banned_users
-                WHERE tg_user_id = %s
+                WHERE tg_user_id = $1
                 """,
-                (tg_user_id,),
+                tg_user_id,
             )
-            row = await cur.fetchone()
-        return dict(row) if row is not None else None
+        if len(self._ban_cache) >= BAN_CACHE_MAX_SIZE:
+            self._ban_cache.clear()
+        self._ban_cache[tg_user_id] = (time.monotonic() + BAN_CACHE_TTL_SECONDS, ban)
+        return ban
 
     async def ban_user(self, tg_user_id: int, reason: str, blocked_by: int | None = None) -> None:
-        async with self.conn.cursor() as cur:
-            await cur.execute(
+        async with self._acquire() as conn:
+            await conn.execute(
                 """
                 INSERT INTO banned_users (tg_user_id, reason, blocked_by, blocked_at)
-                VALUES (%s, %s, %s, %s)
+                VALUES ($1, $2, $3, $4)
                 ON CONFLICT (tg_user_id) DO UPDATE SET
                     reason = EXCLUDED.reason,
                     blocked_by = EXCLUDED.blocked_by,
                     blocked_at = EXCLUDED.blocked_at
                 """,
-                (tg_user_id, reason, blocked_by, now_ts()),
+                tg_user_id, reason, blocked_by, now_ts(),
             )
-        await self.conn.commit()
+        self._ban_cache.pop(tg_user_id, None)
 
     async def unban_user(self, tg_user_id: int) -> bool:
-        async with self.conn.cursor() as cur:
-            await cur.execute(
+        async with self._acquire() as conn:
+            status = await conn.execute(
                 """
                 DELETE FROM banned_users
-                WHERE tg_user_id = %s
+                WHERE tg_user_id = $1
                 """,
-                (tg_user_id,),
+                tg_user_id,
             )
-            changed = cur.rowcount > 0
-        await self.conn.commit()
+            changed = _rowcount(status) > 0
+        self._ban_cache.pop(tg_user_id, None)
         return changed
 
-    async def get_all_links_for_user(self, user_id: int) -> list[dict[str, Any]]:
-        async with self.conn.cursor() as cur:
-            await cur.execute(
+    async def get_all_links_for_user(self, user_id: int) -> list[asyncpg.Record]:
+        async with self._acquire() as conn:
+            return await conn.fetch(
                 """
                 SELECT
                     pl.id,
@@ -624,18 +775,16 @@ class PostgresDatabase:
                 FROM proxy_links pl
                 LEFT JOIN subscriptions s ON s.id = pl.subscription_id
                 LEFT JOIN plans p ON p.code = s.plan_code
-                WHERE pl.user_id = %s
+                WHERE pl.user_id = $1
                 ORDER BY pl.created_at DESC, pl.id DESC
                 """,
-                (user_id,),
+                user_id,
             )
-            rows = await cur.fetchall()
-        return [dict(row) for row in rows]
 
-    async def get_active_links_for_user(self, user_id: int) -> list[dict[str, Any]]:
+    async def get_active_links_for_user(self, user_id: int) -> list[asyncpg.Record]:
         timestamp = now_ts()
-        async with self.conn.cursor() as cur:
-            await cur.execute(
+        async with self._acquire() as conn:
+            return await conn.fetch(
                 """
                 SELECT
                     pl.id,
@@ -648,21 +797,19 @@ class PostgresDatabase:
                 JOIN subscriptions s ON s.id = pl.subscription_id
                 JOIN plans p ON p.code = s.plan_code
                 WHERE
-                    pl.user_id = %s
+                    pl.user_id = $1
                     AND pl.status = 'active'
-                    AND pl.expires_at > %s
+                    AND pl.expires_at > $2
                     AND s.status = 'active'
                 ORDER BY pl.expires_at ASC, pl.subscription_id ASC, pl.device_number ASC
                 """,
-                (user_id, timestamp),
+                user_id, timestamp,
             )
-            rows = await cur.fetchall()
-        return [dict(row) for row in rows]
 
-    async def get_active_subscriptions_for_user(self, user_id: int) -> list[dict[str, Any]]:
+    async def get_active_subscriptions_for_user(self, user_id: int) -> list[asyncpg.Record]:
         timestamp = now_ts()
-        async with self.conn.cursor() as cur:
-            await cur.execute(
+        async with self._acquire() as conn:
+            return await conn.fetch(
                 """
                 SELECT
                     s.id,
@@ -673,168 +820,142 @@ class PostgresDatabase:
                     p.devices_count
                 FROM subscriptions s
                 JOIN plans p ON p.code = s.plan_code
-                WHERE s.user_id = %s AND s.status = 'active' AND s.expires_at > %s
+                WHERE s.user_id = $1 AND s.status = 'active' AND s.expires_at > $2
                 ORDER BY s.expires_at ASC
                 """,
-                (user_id, timestamp),
+                user_id, timestamp,
             )
-            rows = await cur.fetchall()
-        return [dict(row) for row in rows]
 
     async def revoke_proxy_link_for_user(self, user_id: int, proxy_link_id: int) -> bool:
         timestamp = now_ts()
-        await self.conn.execute("BEGIN")
-        try:
-            async with self.conn.cursor() as cur:
-                await cur.execute(
-                    """
-                    SELECT id, subscription_id
-                    FROM proxy_links
-                    WHERE id = %s AND user_id = %s AND status = 'active'
-                    """,
-                    (proxy_link_id, user_id),
-                )
-                row = await cur.fetchone()
-                if row is None:
-                    await self.conn.rollback()
-                    return False
-
-                subscription_id = int(row["subscription_id"])
-
-                await cur.execute(
-                    """
+        async with self._acquire() as conn:
+            # One statement: every CTE sees the same snapshot, so the revoked link is excluded from the "still active" check by id.
+            revoked = await conn.fetchval(
+                """
+                WITH revoked AS (
                     UPDATE proxy_links
-                    SET status = 'expired', expires_at = %s
-                    WHERE id = %s
-                    """,
-                    (timestamp, proxy_link_id),
-                )
-                await cur.execute(
-                    """
+                    SET status = 'expired', expires_at = $3
+                    WHERE id = $1 AND user_id = $2 AND status = 'active'
+                    RETURNING id, subscription_id
+                ),
+                freed AS (
                     UPDATE proxy_pool
-                    SET status = 'free', assigned_link_id = NULL, updated_at = %s
-                    WHERE assigned_link_id = %s
-                    """,
-                    (timestamp, proxy_link_id),
-                )
-                await cur.execute(
-                    """
+                    SET status = 'free', assigned_link_id = NULL, updated_at = $3
+                    WHERE assigned_link_id IN (SELECT id FROM revoked)
+                ),
+                closed AS (
                     UPDATE subscriptions
                     SET status = 'expired'
-                    WHERE id = %s AND status = 'active' AND NOT EXISTS (
+                    WHERE id IN (SELECT subscription_id FROM revoked) AND status = 'active' AND NOT EXISTS (
                         SELECT 1
                         FROM proxy_links
-                        WHERE subscription_id = %s AND status = 'active' AND expires_at > %s
+                        WHERE subscription_id = subscriptions.id
+                            AND status = 'active'
+                            AND expires_at > $3
+                            AND id NOT IN (SELECT id FROM revoked)
                     )
-                    """,
-                    (subscription_id, subscription_id, timestamp),
                 )
-            await self.conn.commit()
-            return True
-        except Exception:
-            await self.conn.rollback()
-            raise
+                SELECT COUNT(*) FROM revoked
+                """,
+                proxy_link_id, user_id, timestamp,
+            )
+        return revoked > 0
 
     async def revoke_all_active_links_for_user(self, user_id: int) -> int:
         timestamp = now_ts()
-        await self.conn.execute("BEGIN")
-        try:
-            async with self.conn.cursor() as cur:
-                await cur.execute(
-                    """
-                    SELECT id
-                    FROM proxy_links
-                    WHERE user_id = %s AND status = 'active' AND expires_at > %s
-                    """,
-                    (user_id, timestamp),
-                )
-                rows = await cur.fetchall()
-                if not rows:
-                    await self.conn.rollback()
-                    return 0
-
-                link_ids = [int(row["id"]) for row in rows]
-
-                await cur.execute(
-                    """
+        async with self._acquire() as conn:
+            revoked = await conn.fetchval(
+                """
+                WITH revoked AS (
                     UPDATE proxy_links
-                    SET status = 'expired', expires_at = %s
-                    WHERE id = ANY(%s)
-                    """,
-                    (timestamp, link_ids),
-                )
-                await cur.execute(
-                    """
+                    SET status = 'expired', expires_at = $2
+                    WHERE user_id = $1 AND status = 'active' AND expires_at > $2
+                    RETURNING id
+                ),
+                freed AS (
                     UPDATE proxy_pool
-                    SET status = 'free', assigned_link_id = NULL, updated_at = %s
-                    WHERE assigned_link_id = ANY(%s)
-                    """,
-                    (timestamp, link_ids),
-                )
-                await cur.execute(
-                    """
+                    SET status = 'free', assigned_link_id = NULL, updated_at = $2
+                    WHERE assigned_link_id IN (SELECT id FROM revoked)
+                ),
+                closed AS (
                     UPDATE subscriptions
                     SET status = 'expired'
-                    WHERE user_id = %s AND status = 'active' AND NOT EXISTS (
+                    WHERE user_id = $1 AND status = 'active' AND EXISTS (SELECT 1 FROM revoked) AND NOT EXISTS (
                         SELECT 1
                         FROM proxy_links
-                        WHERE subscription_id = subscriptions.id AND status = 'active' AND expires_at > %s
+                        WHERE subscription_id = subscriptions.id
+                            AND status = 'active'
+                            AND expires_at > $2
+                            AND id NOT IN (SELECT id FROM revoked)
                     )
-                    """,
-                    (user_id, timestamp),
-                )
-            await self.conn.commit()
-            return len(link_ids)
-        except Exception:
-            await self.conn.rollback()
-            raise
-
-    async def expire_due_and_get_notified_users(self) -> list[int]:
-        timestamp = now_ts()
-        async with self.conn.cursor() as cur:
-            await cur.execute(
-                """
-                UPDATE subscriptions
-                SET status = 'expired'
-                WHERE status = 'active' AND expires_at <= %s
-                """,
-                (timestamp,),
-            )
-            await cur.execute(
-                """
-                UPDATE proxy_links
-                SET status = 'expired'
-                WHERE status = 'active' AND expires_at <= %s
-                """,
-                (timestamp,),
-            )
-            await cur.execute(
-                """
-                UPDATE proxy_pool
-                SET status = 'free', assigned_link_id = NULL, updated_at = %s
-                WHERE assigned_link_id IN (
-                    SELECT id FROM proxy_links WHERE status = 'expired'
                 )
+                SELECT COUNT(*) FROM revoked
                 """,
-                (timestamp,),
+                user_id, timestamp,
             )
+        return int(revoked)
 
-            await cur.execute(
-                """
-                SELECT DISTINCT u.tg_user_id
-                FROM subscriptions s
-                JOIN users u ON u.id = s.user_id
-                WHERE s.status = 'expired' AND s.notified_expired = 0
-                """
-            )
-            rows = await cur.fetchall()
-
-            await cur.execute(
-                """
-                UPDATE subscriptions
-                SET notified_expired = 1
-                WHERE status = 'expired' AND notified_expired = 0
-                """
-            )
-        await self.conn.commit()
-        return [int(row["tg_user_id"]) for row in rows]
+    async def expire_due_and_get_notified_users(self) -> list[int]:
+        timestamp = now_ts()
+        tg_user_ids: dict[int, None] = {}
+        async with self._acquire() as conn:
+            # Bounded batches keep each statement's locks and WAL small when a large backlog falls due at once.
+            # Subscriptions already expired by a revoke are picked up for notification too.
+            while True:
+                # Without the opt-in the batch is a single autocommitted statement: one round-trip, no BEGIN/COMMIT.
+                async with conn.transaction() if self.async_expiry_commit else nullcontext():
+                    if self.async_expiry_commit:
+                        # Opt-in: a crash may drop the last batch, which the next tick then simply redoes.
+                        await conn.execute("SET LOCAL synchronous_commit = off")
+                    row = await conn.fetchrow(
+                        """
+                        WITH due_subscription AS (
+                            SELECT id
+                            FROM subscriptions
+                            WHERE (status = 'active' AND expires_at <= $1)
+                               OR (status = 'expired' AND notified_expired = 0)
+                            LIMIT $2
+                            FOR UPDATE SKIP LOCKED
+                        ),
+                        expired_subscription AS (
+                            UPDATE subscriptions
+                            SET status = 'expired', notified_expired = 1
+                            FROM due_subscription
+                            WHERE subscriptions.id = due_subscription.id
+                            RETURNING subscriptions.user_id
+                        ),
+                        due_link AS (
+                            SELECT id
+                            FROM proxy_links
+                            WHERE status = 'active' AND expires_at <= $1
+                            LIMIT $2
+                            FOR UPDATE SKIP LOCKED
+                        ),
+                        expired_link AS (
+                            UPDATE proxy_links
+                            SET status = 'expired'
+                            FROM due_link
+                            WHERE proxy_links.id = due_link.id
+                            RETURNING proxy_links.id
+                        ),
+                        freed AS (
+                            UPDATE proxy_pool
+                            SET status = 'free', assigned_link_id = NULL, updated_at = $1
+                            FROM expired_link
+                            WHERE proxy_pool.assigned_link_id = expired_link.id
+                        )
+                        SELECT
+                            (
+                                SELECT COALESCE(array_agg(u.tg_user_id), '{}')
+                                FROM users u
+                                WHERE EXISTS (SELECT 1 FROM expired_subscription s WHERE s.user_id = u.id)
+                            ) AS tg_user_ids,
+                            (SELECT COUNT(*) FROM expired_subscription) AS subscriptions,
+                            (SELECT COUNT(*) FROM expired_link) AS links
+                        """,
+                        timestamp, EXPIRY_BATCH_SIZE,
+                    )
+                tg_user_ids.update(dict.fromkeys(row["tg_user_ids"]))
+                if row["subscriptions"] < EXPIRY_BATCH_SIZE and row["links"] < EXPIRY_BATCH_SIZE:
+                    break
+        return list(tg_user_ids)
@@ -1,13 +1,20 @@
 from __future__ import annotations
 
+import asyncio
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
+from functools import cache, lru_cache
 import logging
 from typing import Iterable
-from urllib.parse import unquote, urlencode, urlparse
+from urllib.parse import quote_plus, unquote, urlparse
 
 from aiogram import F, Router
-from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramRetryAfter,
+)
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -35,6 +42,8 @@ MAX_ACTIVE_PROXIES_PER_USER = 5
 BLOCKED_TG_USER_ID = 1664076316
 BLOCKED_USER_TEXT = "ЛАВРЕНТ ИДИ НАХУЙ, СУКА!\n\nЗа 25₽ мне на карту ты помилован"
 DEFAULT_BAN_TEXT = "Доступ к боту ограничен администратором."
+# Telegram allows about 30 messages per second per bot.
+BROADCAST_RATE_PER_SECOND = 30
 
 
 class AdminStates(StatesGroup):
@@ -56,6 +65,15 @@ class UserProfile:
     last_name: str | None
 
 
+@dataclass(frozen=True)
+class ProxyItem:
+    index: int
+    proxy_id: int
+    tg_link: str
+    subscription_id: int | None
+    device_number: int | None
+
+
 def format_ts(timestamp: int) -> str:
     dt = datetime.fromtimestamp(timestamp, tz=timezone.utc)
     return dt.strftime("%d.%m.%Y %H:%M UTC")
@@ -76,18 +94,26 @@ def tg_emoji(emoji_id: str, fallback: str) -> str:
     return f'<tg-emoji emoji-id="{emoji_id}">{fallback}</tg-emoji>'
 
 
+TG_SHIELD = tg_emoji(EMOJI_SHIELD, "🛡")
+TG_GEM = tg_emoji(EMOJI_GEM, "💎")
+TG_DEV = tg_emoji(EMOJI_DEV, "📱")
+TG_BOX = tg_emoji(EMOJI_BOX, "📦")
+
+
+@cache
 def build_welcome_text() -> str:
     return (
-        f"{tg_emoji(EMOJI_SHIELD, '🛡')} <b>ProxyBot</b> выдает персональные SOCKS5-прокси,\n"
+        f"{TG_SHIELD} <b>ProxyBot</b> выдает персональные SOCKS5-прокси,\n"
         "привязанные к вашему Telegram-профилю.\n\n"
-        f"{tg_emoji(EMOJI_GEM, '💎')} Каждая покупка действует <b>30 дней</b>.\n"
-        f"{tg_emoji(EMOJI_DEV, '📱')} Подключение в Telegram — в пару кликов."
+        f"{TG_GEM} Каждая покупка действует <b>30 дней</b>.\n"
+        f"{TG_DEV} Подключение в Telegram — в пару кликов."
     )
 
 
+@cache
 def build_help_text() -> str:
     return (
-        f"{tg_emoji(EMOJI_SHIELD, '🛡')} <b>Команды бота</b>\n\n"
+        f"{TG_SHIELD} <b>Команды бота</b>\n\n"
         "/start — главное меню\n"
         "/plans — тарифы\n"
         "/buy — купить тариф\n"
@@ -98,8 +124,14 @@ def build_help_text() -> str:
 
 
 def build_plans_text(plans: list[Plan]) -> str:
+    return _build_plans_text(tuple(plans))
+
+
+# The catalog rarely changes, and Plan is frozen, so the rendered text is reused for equal plan tuples.
+@lru_cache(maxsize=8)
+def _build_plans_text(plans: tuple[Plan, ...]) -> str:
     lines = [
-        f"{tg_emoji(EMOJI_SHIELD, '🛡')} <b>Тарифы ProxyBot</b>",
+        f"{TG_SHIELD} <b>Тарифы ProxyBot</b>",
         "",
         "Выберите подходящий план на <b>30 дней</b>:",
         "",
@@ -109,15 +141,16 @@ def build_plans_text(plans: list[Plan]) -> str:
     lines.extend(
         [
             "",
-            f"{tg_emoji(EMOJI_GEM, '💎')} После подтверждения оплаты прокси выдаются сразу.",
+            f"{TG_GEM} После подтверждения оплаты прокси выдаются сразу.",
         ]
     )
     return "\n".join(lines)
 
 
+@cache
 def build_admin_panel_text() -> str:
     return (
-        f"{tg_emoji(EMOJI_SHIELD, '🛡')} <b>Админ-панель</b>\n\n"
+        f"{TG_SHIELD} <b>Админ-панель</b>\n\n"
         "Выберите действие из меню ниже."
     )
 
@@ -191,6 +224,16 @@ async def ensure_user(
     bot=None,
     admin_tg_ids: set[int] | None = None,
 ) -> int:
+    # Unchanged profiles skip the upsert while the database still remembers them.
+    cached_user_id = db.cached_user_id(
+        telegram_user.id,
+        telegram_user.username,
+        telegram_user.first_name,
+        telegram_user.last_name,
+    )
+    if cached_user_id is not None:
+        return cached_user_id
+
     existed = await db.get_user_by_tg_user_id(telegram_user.id)
     user_id = await db.upsert_user(
         tg_user_id=telegram_user.id,
@@ -209,13 +252,16 @@ async def ensure_user(
             f"Username: {username}\n"
             f"Имя: {full_name}"
         )
-        for admin_id in admin_tg_ids:
-            if admin_id == telegram_user.id:
-                continue
-            try:
-                await bot.send_message(admin_id, text, parse_mode=None)
-            except (TelegramBadRequest, TelegramForbiddenError):
+        recipients = [admin_id for admin_id in admin_tg_ids if admin_id != telegram_user.id]
+        results = await asyncio.gather(
+            *(bot.send_message(admin_id, text, parse_mode=None) for admin_id in recipients),
+            return_exceptions=True,
+        )
+        for admin_id, result in zip(recipients, results):
+            if isinstance(result, (TelegramBadRequest, TelegramForbiddenError)):
                 logger.warning("Could not send new-user notification to admin %s", admin_id)
+            elif isinstance(result, BaseException):
+                raise result
     return user_id
 
 
@@ -261,15 +307,11 @@ def profile_label(telegram_user: TelegramUser) -> str:
 
 
 def telegram_socks_link(server: str, port: int, username: str, password: str) -> str:
-    query = urlencode(
-        {
-            "server": server,
-            "port": port,
-            "user": username,
-            "pass": password,
-        }
+    # Same output as urlencode(), without building a dict per link.
+    return (
+        f"https://t.me/socks?server={quote_plus(server)}&port={port}"
+        f"&user={quote_plus(username)}&pass={quote_plus(password)}"
     )
-    return f"https://t.me/socks?{query}"
 
 
 def parse_socks5_url(link: str) -> tuple[str, int, str, str] | None:
@@ -337,11 +379,45 @@ async def log_proxy_delivery(
 
 async def cleanup_proxy_output_messages(*, db: Database, bot, user_id: int) -> None:
     rows = await db.pop_temp_messages(user_id=user_id, kind=TEMP_KIND_PROXY_OUTPUT)
+    message_ids: dict[int, list[int]] = {}
     for row in rows:
-        try:
-            await bot.delete_message(int(row["tg_user_id"]), int(row["message_id"]))
-        except TelegramBadRequest:
-            pass
+        message_ids.setdefault(int(row["tg_user_id"]), []).append(int(row["message_id"]))
+    # deleteMessages removes up to 100 messages of one chat per request and skips the ones already gone.
+    for chat_id, ids in message_ids.items():
+        for offset in range(0, len(ids), 100):
+            try:
+                await bot.delete_messages(chat_id, ids[offset : offset + 100])
+            except TelegramBadRequest:
+                pass
+
+
+async def send_broadcast_message(bot, slots: asyncio.Semaphore, tg_user_id: int, payload: str) -> bool:
+    try:
+        for _ in range(2):
+            try:
+                await bot.send_message(tg_user_id, payload, parse_mode=None)
+                return True
+            except TelegramRetryAfter as exc:
+                await asyncio.sleep(exc.retry_after)
+        return False
+    except TelegramAPIError:
+        # Covers network errors too: one failed recipient is counted, not allowed to abort the whole broadcast.
+        return False
+    finally:
+        slots.release()
+
+
+async def broadcast_to_all(db: Database, bot, payload: str) -> tuple[int, int]:
+    # Sends overlap on the network; starts are paced to the API limit and in-flight sends are capped at the same number.
+    slots = asyncio.Semaphore(BROADCAST_RATE_PER_SECOND)
+    tasks: list[asyncio.Task[bool]] = []
+    async for tg_user_id in db.iter_all_tg_user_ids():
+        await slots.acquire()
+        tasks.append(asyncio.create_task(send_broadcast_message(bot, slots, tg_user_id, payload)))
+        await asyncio.sleep(1 / BROADCAST_RATE_PER_SECOND)
+    results = await asyncio.gather(*tasks)
+    sent_ok = sum(results)
+    return sent_ok, len(results) - sent_ok
 
 
 async def edit_or_send(
@@ -374,7 +450,7 @@ async def send_links_list(
     links = await db.get_active_links_for_user(user_id)
     if not links:
         text = (
-            f"{tg_emoji(EMOJI_DEV, '📱')} У вас пока нет активных прокси.\n"
+            f"{TG_DEV} У вас пока нет активных прокси.\n"
             "Выберите тариф через /buy или кнопку «Тарифы»."
         )
         if source_message is not None:
@@ -383,22 +459,21 @@ async def send_links_list(
             await bot.send_message(bot_chat_id, text, reply_markup=main_menu_keyboard())
         return
 
-    proxies: list[dict[str, int | str | None]] = []
+    proxies: list[ProxyItem] = []
     for index, row in enumerate(links, start=1):
         parsed = parse_socks5_url(str(row["link"]))
         if parsed is None:
             continue
         host, port, username, password = parsed
         tg_link = telegram_socks_link(host, port, username, password)
-        proxy_id = int(row["id"])
         proxies.append(
-            {
-                "index": index,
-                "proxy_id": proxy_id,
-                "tg_link": tg_link,
-                "subscription_id": int(row["subscription_id"]),
-                "device_number": int(row["device_number"]),
-            }
+            ProxyItem(
+                index=index,
+                proxy_id=int(row["id"]),
+                tg_link=tg_link,
+                subscription_id=int(row["subscription_id"]),
+                device_number=int(row["device_number"]),
+            )
         )
 
     await send_proxy_sequence(
@@ -422,7 +497,7 @@ async def send_proxy_sequence(
     user_id: int,
     tg_user_id: int,
     user_proxy_label: str,
-    proxies: list[dict[str, int | str | None]],
+    proxies: list[ProxyItem],
     delivery_source: str,
     source_message: Message | None = None,
 ) -> None:
@@ -442,43 +517,44 @@ async def send_proxy_sequence(
         )
         return
 
-    for item in proxies:
-        text = build_proxy_block(
-            proxy_index=int(item["index"]),
-            user_proxy_label=user_proxy_label,
-            proxy_id=int(item["proxy_id"]),
-            tg_link=str(item["tg_link"]),
-        )
-        sent = await bot.send_message(bot_chat_id, text, parse_mode=None)
-        await db.add_temp_message(
-            user_id=user_id,
-            tg_user_id=tg_user_id,
-            message_id=sent.message_id,
-            kind=TEMP_KIND_PROXY_OUTPUT,
-        )
-        await log_proxy_delivery(
-            db=db,
-            proxy_id=int(item["proxy_id"]),
-            user_id=user_id,
-            tg_user_id=tg_user_id,
-            user_proxy_label=user_proxy_label,
-            subscription_id=int(item["subscription_id"]) if item["subscription_id"] is not None else None,
-            device_number=int(item["device_number"]) if item["device_number"] is not None else None,
-            delivery_source=delivery_source,
-            tg_link=str(item["tg_link"]),
-        )
+    # Sends stay sequential to keep the chat order; the sent ids are recorded in one write, even if a send fails midway.
+    message_ids: list[int] = []
+    try:
+        for item in proxies:
+            text = build_proxy_block(
+                proxy_index=item.index,
+                user_proxy_label=user_proxy_label,
+                proxy_id=item.proxy_id,
+                tg_link=item.tg_link,
+            )
+            sent = await bot.send_message(bot_chat_id, text, parse_mode=None)
+            message_ids.append(sent.message_id)
+            await log_proxy_delivery(
+                db=db,
+                proxy_id=item.proxy_id,
+                user_id=user_id,
+                tg_user_id=tg_user_id,
+                user_proxy_label=user_proxy_label,
+                subscription_id=item.subscription_id,
+                device_number=item.device_number,
+                delivery_source=delivery_source,
+                tg_link=item.tg_link,
+            )
 
-    control = await bot.send_message(
-        bot_chat_id,
-        "Перейти в главное меню:",
-        reply_markup=back_to_menu_keyboard(),
-    )
-    await db.add_temp_message(
-        user_id=user_id,
-        tg_user_id=tg_user_id,
-        message_id=control.message_id,
-        kind=TEMP_KIND_PROXY_OUTPUT,
-    )
+        control = await bot.send_message(
+            bot_chat_id,
+            "Перейти в главное меню:",
+            reply_markup=back_to_menu_keyboard(),
+        )
+        message_ids.append(control.message_id)
+    finally:
+        if message_ids:
+            await db.add_temp_messages(
+                user_id=user_id,
+                tg_user_id=tg_user_id,
+                message_ids=message_ids,
+                kind=TEMP_KIND_PROXY_OUTPUT,
+            )
 
 
 async def send_status(
@@ -491,14 +567,14 @@ async def send_status(
 ) -> None:
     subscriptions = await db.get_active_subscriptions_for_user(user_id)
     if not subscriptions:
-        text = f"{tg_emoji(EMOJI_BOX, '📦')} У вас нет активной подписки.\nОформите тариф через /buy."
+        text = f"{TG_BOX} У вас нет активной подписки.\nОформите тариф через /buy."
         if edit_message is not None:
             await edit_message.edit_text(text, reply_markup=main_menu_keyboard())
         else:
             await bot.send_message(bot_chat_id, text, reply_markup=main_menu_keyboard())
         return
 
-    lines = [f"{tg_emoji(EMOJI_BOX, '📦')} <b>Активные подписки</b>", ""]
+    lines = [f"{TG_BOX} <b>Активные подписки</b>", ""]
     for sub in subscriptions:
         expires_at = int(sub["expires_at"])
         lines.append(
@@ -755,7 +831,7 @@ def create_router(db: Database, proxy_public_host: str, admin_tg_ids: tuple[int,
         if not await ensure_admin_callback_access(callback, state):
             return
         await state.clear()
-        rows = await db.list_users_with_stats(limit=500, offset=0)
+        rows = await db.list_users_with_stats(limit=500)
         if not rows:
             await edit_or_send(
                 callback,
@@ -849,15 +925,7 @@ def create_router(db: Database, proxy_public_host: str, admin_tg_ids: tuple[int,
             await message.answer("Отправьте текстовое сообщение.")
             return
 
-        targets = await db.get_all_tg_user_ids()
-        sent_ok = 0
-        sent_fail = 0
-        for tg_user_id in targets:
-            try:
-                await message.bot.send_message(tg_user_id, payload, parse_mode=None)
-                sent_ok += 1
-            except (TelegramBadRequest, TelegramForbiddenError):
-                sent_fail += 1
+        sent_ok, sent_fail = await broadcast_to_all(db, message.bot, payload)
 
         await state.clear()
         await message.answer(
@@ -1052,20 +1120,24 @@ def create_router(db: Database, proxy_public_host: str, admin_tg_ids: tuple[int,
             await message.answer("Не найден подходящий тариф для выбранного количества.")
             return
 
-        payment_id = await db.create_payment(
-            user_id=profile.id,
-            plan_code=plan.code,
-            amount_rub=0,
-        )
         expires_at = int((datetime.now(tz=timezone.utc) + timedelta(days=days)).timestamp())
-        activated = await db.activate_payment_and_create_subscription_from_pool(
-            payment_id=payment_id,
-            user_id=profile.id,
-            plan_code=plan.code,
-            expires_at=expires_at,
-            devices_count=devices_count,
-            proxy_public_host=proxy_public_host,
-        )
+        # The zero-priced payment only exists to back the grant, so it is rolled back if activation fails.
+        async with db.transaction() as tx:
+            payment_id = await db.create_payment(
+                user_id=profile.id,
+                plan_code=plan.code,
+                amount_rub=0,
+            )
+            activated = await db.activate_payment_and_create_subscription_from_pool(
+                payment_id=payment_id,
+                user_id=profile.id,
+                plan_code=plan.code,
+                expires_at=expires_at,
+                devices_count=devices_count,
+                proxy_public_host=proxy_public_host,
+            )
+            if activated is None:
+                await tx.rollback()
         if activated is None:
             free_count = await db.count_free_pool()
             await message.answer(
@@ -1074,7 +1146,7 @@ def create_router(db: Database, proxy_public_host: str, admin_tg_ids: tuple[int,
             return
         subscription_id, created_proxies = activated
 
-        proxies: list[dict[str, int | str | None]] = []
+        proxies: list[ProxyItem] = []
         for index, proxy in enumerate(created_proxies, start=1):
             tg_link = telegram_socks_link(
                 proxy_public_host,
@@ -1083,13 +1155,13 @@ def create_router(db: Database, proxy_public_host: str, admin_tg_ids: tuple[int,
                 str(proxy["password"]),
             )
             proxies.append(
-                {
-                    "index": index,
-                    "proxy_id": int(proxy["proxy_id"]),
-                    "tg_link": tg_link,
-                    "subscription_id": subscription_id,
-                    "device_number": int(proxy["device_number"]),
-                }
+                ProxyItem(
+                    index=index,
+                    proxy_id=int(proxy["proxy_id"]),
+                    tg_link=tg_link,
+                    subscription_id=subscription_id,
+                    device_number=int(proxy["device_number"]),
+                )
             )
 
         await send_proxy_sequence(
@@ -1276,7 +1348,7 @@ def create_router(db: Database, proxy_public_host: str, admin_tg_ids: tuple[int,
         await edit_or_send(
             callback,
             text=(
-                f"{tg_emoji(EMOJI_GEM, '💎')} <b>Заявка на оплату создана</b>\n\n"
+                f"{TG_GEM} <b>Заявка на оплату создана</b>\n\n"
                 f"Тариф: <b>{plan.title}</b>\n"
                 f"Сумма: <b>{plan.price_rub}₽</b>\n"
                 f"ID платежа: <code>{payment_id}</code>\n\n"
@@ -1381,7 +1453,7 @@ def create_router(db: Database, proxy_public_host: str, admin_tg_ids: tuple[int,
         subscription_id, created_proxies = activated
 
         user_proxy_label = profile_label(callback.from_user)
-        proxies: list[dict[str, int | str | None]] = []
+        proxies: list[ProxyItem] = []
         for index, proxy in enumerate(created_proxies, start=1):
             tg_link = telegram_socks_link(
                 proxy_public_host,
@@ -1389,15 +1461,14 @@ def create_router(db: Database, proxy_public_host: str, admin_tg_ids: tuple[int,
                 str(proxy["username"]),
                 str(proxy["password"]),
             )
-            proxy_id = int(proxy["proxy_id"])
             proxies.append(
-                {
-                    "index": index,
-                    "proxy_id": proxy_id,
-                    "tg_link": tg_link,
-                    "subscription_id": subscription_id,
-                    "device_number": int(proxy["device_number"]),
-                }
+                ProxyItem(
+                    index=index,
+                    proxy_id=int(proxy["proxy_id"]),
+                    tg_link=tg_link,
+                    subscription_id=subscription_id,
+                    device_number=int(proxy["device_number"]),
+                )
             )
 
         await send_proxy_sequence(
@@ -54,8 +54,8 @@ TABLES_WITH_ID = [
 
 
 async def truncate_postgres(pg: PostgresDatabase) -> None:
-    async with pg.conn.cursor() as cur:
-        await cur.execute(
+    async with pg.pool.acquire() as conn:
+        await conn.execute(
             """
             TRUNCATE TABLE
                 user_temp_messages,
@@ -70,7 +70,6 @@ async def truncate_postgres(pg: PostgresDatabase) -> None:
             RESTART IDENTITY CASCADE
             """
         )
-    await pg.conn.commit()
 
 
 def read_sqlite_rows(conn: sqlite3.Connection, table: str, columns: list[str]) -> list[tuple]:
@@ -88,18 +87,15 @@ async def insert_rows(pg: PostgresDatabase, table: str, columns: list[str], rows
     if not rows:
         return 0
 
-    placeholders = ", ".join(["%s"] * len(columns))
-    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})"
-    async with pg.conn.cursor() as cur:
-        await cur.executemany(sql, rows)
-    await pg.conn.commit()
+    async with pg.pool.acquire() as conn:
+        await conn.copy_records_to_table(table, records=rows, columns=columns)
     return len(rows)
 
 
 async def reset_sequences(pg: PostgresDatabase) -> None:
-    async with pg.conn.cursor() as cur:
+    async with pg.pool.acquire() as conn:
         for table in TABLES_WITH_ID:
-            await cur.execute(
+            await conn.execute(
                 f"""
                 SELECT setval(
                     pg_get_serial_sequence('{table}', 'id'),
@@ -109,7 +105,6 @@ async def reset_sequences(pg: PostgresDatabase) -> None:
                 FROM {table}
                 """
             )
-    await pg.conn.commit()
 
 
 async def migrate(*, sqlite_path: str, postgres_url: str, truncate_first: bool) -> None: